@@ -1,5 +1,12 @@
+import os
 import sys
-from .dmm import DMM, split_atom_groups
+import time
+import filecmp
+import argparse
+import subprocess
+import concurrent.futures
+from collections import Counter
+from .dmm import DMM, AtomTable, Coordinate, ENCODING, _parse, _parse_dictionary, num_to_key, split_tgm_columns, estimate_parse_memory
 
 def diff_turf_or_area(old, new):
     result = []
@@ -17,53 +24,114 @@ def diff_turf_or_area(old, new):
 def create_obj(name, desc):
     return f'/obj{{name = "{name}";\n\tdesc = "{desc}"}}'
 
-def create_diff(dmm_old, dmm_new, filename):
-    if dmm_old.size != dmm_new.size:
-        return 0, None, f"Size changed: {dmm_old.size} to {dmm_new.size}", 0, 0, 0, 0, filename
+def marker_text(text):
+    # save_tgm doesn't understand escaped quotes, so var values keep their quotes as '
+    return text.replace('\\', '\\\\').replace('"', "'")
+
+def _ordered_difference(movables, counts):
+    # the atoms of a Counter difference, in the order they appear on the tile
+    remaining = counts.copy()
+    result = []
+    for atom_id in movables:
+        if remaining[atom_id] > 0:
+            remaining[atom_id] -= 1
+            result.append(atom_id)
+    return result
 
-    diffed_dmm = DMM(dmm_old.key_length, dmm_old.size)
-    diffed_dmm.dictionary = dmm_old.dictionary.copy()
+def pair_varedits(old, new, atoms):
+    # movables only on one side, with deleted and added atoms of the same path paired up as edits
+    # returns (added, deleted, edited), where edited is a list of (old atom, new atom)
+    deleted_by_path = {}
+    for atom_id in _ordered_difference(old.movables, old.movable_counts - new.movable_counts):
+        deleted_by_path.setdefault(atoms.parse(atom_id)[0], []).append(atom_id)
+    added = []
+    edited = []
+    for atom_id in _ordered_difference(new.movables, new.movable_counts - old.movable_counts):
+        candidates = deleted_by_path.get(atoms.parse(atom_id)[0])
+        if candidates:
+            edited.append((candidates.pop(0), atom_id))
+        else:
+            added.append(atom_id)
+    deleted = [atom_id for candidates in deleted_by_path.values() for atom_id in candidates]
+    return added, deleted, edited
 
-    note = f"Key length changed: {dmm_old.key_length} to {dmm_new.key_length}" if dmm_old.key_length != dmm_new.key_length else None
+def describe_vars(vars):
+    return "; ".join(f"{name} = {value}" for name, value in vars.items())
+
+def describe_varedit(old_vars, new_vars):
+    changes = []
+    for name in list(old_vars) + [name for name in new_vars if not name in old_vars]:
+        old_value = old_vars.get(name, "(default)")
+        new_value = new_vars.get(name, "(default)")
+        if old_value != new_value:
+            changes.append(f"{name}: {old_value} TO {new_value}")
+    return "; ".join(changes)
+
+def varedit_markers(added, deleted, edited, atoms):
+    # one small object per changed movable, instead of both full movable lists
+    markers = []
+    for old_id, new_id in edited:
+        path, new_vars = atoms.parse(new_id)
+        markers.append(create_obj(f"VAREDIT: {path}", marker_text(describe_varedit(atoms.parse(old_id)[1], new_vars))))
+    for atom_id in added:
+        path, vars = atoms.parse(atom_id)
+        markers.append(create_obj(f"ADDED: {path}", marker_text(describe_vars(vars))))
+    for atom_id in deleted:
+        path, vars = atoms.parse(atom_id)
+        markers.append(create_obj(f"DELETED: {path}", marker_text(describe_vars(vars))))
+    return markers
+
+def diff_tiles(coords, old_grid, new_grid, old_groups, new_groups, atoms, diffed_dmm, varedits=False):
+    # diffs the given coordinates into diffed_dmm, whose dictionary must be a copy of the old one
+    # with varedits, movables of the same path are paired up and only their changed vars are marked
+    diffed_grid = diffed_dmm.grid
+    # (old key, new key) -> (added, deleted, markers), for varedits
+    movable_changes = {}
     tiles_changed = 0
     movables_added = 0
     movables_deleted = 0
     turfs_changed = 0
     areas_changed = 0
 
-    for (z, y, x) in dmm_old.coords_zyx:
-        coord = x, y, z
-        old_tile = dmm_old.get_tile(coord)
-        new_tile = dmm_new.get_tile(coord)
+    for coord in coords:
+        old_key = old_grid[coord]
+        old = old_groups[old_key]
+        new = new_groups[new_grid[coord]]
 
-        # Nothing
-        if old_tile == new_tile:
-            diffed_dmm.set_tile(coord, old_tile)
+        # Nothing (the diff dictionary is a copy of the old one, so the old key can be reused)
+        if old is new:
+            diffed_grid[coord] = old_key
             continue
         tiles_changed += 1
-        old_movables, old_turfs, old_areas = split_atom_groups(old_tile)
-        new_movables, new_turfs, new_areas = split_atom_groups(new_tile)
 
-        area, area_notice = diff_turf_or_area(old_areas, new_areas)
-        turf, turf_notice = diff_turf_or_area(old_turfs, new_turfs)
+        area, area_notice = diff_turf_or_area(atoms.strings(old.areas), atoms.strings(new.areas))
+        turf, turf_notice = diff_turf_or_area(atoms.strings(old.turfs), atoms.strings(new.turfs))
 
+        new_movables = atoms.strings(new.movables)
         movables = new_movables
 
-        if old_movables != new_movables:
-            for movable in set(old_movables + new_movables):
-                oldcount = old_movables.count(movable)
-                newcount = new_movables.count(movable)
-                # Added
-                if oldcount < newcount:
-                    movables_added += newcount - oldcount
-                # Deleted
-                elif oldcount > newcount:
-                    movables_deleted += oldcount - newcount
-            movables = [create_obj("---NEW---", "new version's movables below this")] \
-                + new_movables \
-                + [create_obj("---OLD---", "old version's movables below this")] \
-                + old_movables \
-                + [create_obj("---END---", "end of movables diff")]
+        if old.movables != new.movables:
+            markers = None
+            if varedits:
+                new_key = new_grid[coord]
+                changes = movable_changes.get((old_key, new_key))
+                if changes is None:
+                    added, deleted, edited = pair_varedits(old, new, atoms)
+                    changes = movable_changes[old_key, new_key] = (len(added), len(deleted), varedit_markers(added, deleted, edited, atoms))
+                added_count, deleted_count, markers = changes
+            # a change only in order has no markers, and is shown in full
+            if markers:
+                movables_added += added_count
+                movables_deleted += deleted_count
+                movables = new_movables + markers
+            else:
+                movables_added += sum((new.movable_counts - old.movable_counts).values())
+                movables_deleted += sum((old.movable_counts - new.movable_counts).values())
+                movables = [create_obj("---NEW---", "new version's movables below this")] \
+                    + new_movables \
+                    + [create_obj("---OLD---", "old version's movables below this")] \
+                    + atoms.strings(old.movables) \
+                    + [create_obj("---END---", "end of movables diff")]
         if not turf_notice is None:
             movables += [create_obj("TURF DIFF: " + turf_notice, turf_notice)]
             turfs_changed += 1
@@ -72,23 +140,278 @@ def create_diff(dmm_old, dmm_new, filename):
             areas_changed += 1
 
         diffed_dmm.set_tile(coord, movables + turf + area)
+    return tiles_changed, movables_added, movables_deleted, turfs_changed, areas_changed
+
+def count_changes(key_pairs, old_groups, new_groups, atoms=None, varedits=False):
+    # same counts as diff_tiles without building anything, from a Counter of (old key, new key) per tile
+    tiles_changed = 0
+    movables_added = 0
+    movables_deleted = 0
+    turfs_changed = 0
+    areas_changed = 0
+
+    for (old_key, new_key), count in key_pairs.items():
+        old = old_groups[old_key]
+        new = new_groups[new_key]
+        if old is new:
+            continue
+        tiles_changed += count
+        if old.movables != new.movables and varedits:
+            added, deleted, _ = pair_varedits(old, new, atoms)
+            movables_added += count * len(added)
+            movables_deleted += count * len(deleted)
+        elif old.movables != new.movables:
+            movables_added += count * sum((new.movable_counts - old.movable_counts).values())
+            movables_deleted += count * sum((old.movable_counts - new.movable_counts).values())
+        if old.turfs and new.turfs and old.turfs[-1] != new.turfs[-1]:
+            turfs_changed += count
+        if old.areas and new.areas and old.areas[-1] != new.areas[-1]:
+            areas_changed += count
+    return tiles_changed, movables_added, movables_deleted, turfs_changed, areas_changed
+
+def create_diff(dmm_old, dmm_new, filename, atoms=None, stats_only=False, varedits=False):
+    # with stats_only, only the counts are computed and no diffed map is returned
+    # with varedits, a movable replaced by one of the same path counts as edited rather than added and deleted
+    if dmm_old.size != dmm_new.size:
+        return 0, None, f"Size changed: {dmm_old.size} to {dmm_new.size}", 0, 0, 0, 0, filename
+
+    if atoms is None:
+        atoms = AtomTable()
+    old_groups = atoms.dictionary_groups(dmm_old.dictionary)
+    new_groups = atoms.dictionary_groups(dmm_new.dictionary)
+
+    note = f"Key length changed: {dmm_old.key_length} to {dmm_new.key_length}" if dmm_old.key_length != dmm_new.key_length else None
+    if stats_only:
+        diffed_dmm = None
+        old_grid = dmm_old.grid
+        new_grid = dmm_new.grid
+        key_pairs = Counter((old_grid[coord], new_grid[coord]) for coord in old_grid)
+        tiles_changed, movables_added, movables_deleted, turfs_changed, areas_changed = count_changes(key_pairs, old_groups, new_groups, atoms, varedits)
+    else:
+        diffed_dmm = DMM(dmm_old.key_length, dmm_old.size)
+        diffed_dmm.dictionary = dmm_old.dictionary.copy()
+        coords = ((x, y, z) for (z, y, x) in dmm_old.coords_zyx)
+        tiles_changed, movables_added, movables_deleted, turfs_changed, areas_changed = \
+            diff_tiles(coords, dmm_old.grid, dmm_new.grid, old_groups, new_groups, atoms, diffed_dmm, varedits)
     if tiles_changed == 0:
         note = "No visible changes"
     return tiles_changed, diffed_dmm, note, movables_added, movables_deleted, turfs_changed, areas_changed, filename
 
+def _tgm_key_lookup(dictionary, duplicate_keys, key_length):
+    # raw key string -> deduplicated key number
+    keys = {num_to_key(key, key_length, True): key for key in dictionary.keys()}
+    for key, kept in duplicate_keys.items():
+        keys[num_to_key(key, key_length, True)] = kept
+    return keys
+
+def _create_tgm_column_diff(old_split, new_split, filename, atoms, stats_only, varedits):
+    # returns None whenever the full parse should be used instead
+    old_dictionary_text, old_columns = old_split
+    new_dictionary_text, new_columns = new_split
+    if old_columns.keys() != new_columns.keys():
+        return None
+
+    old_dictionary, old_duplicates, key_length, _ = _parse_dictionary(iter(old_dictionary_text), atoms)
+    new_dictionary, new_duplicates, new_key_length, _ = _parse_dictionary(iter(new_dictionary_text), atoms)
+    if not old_dictionary or not new_dictionary or key_length != new_key_length:
+        return None
+    old_keys = _tgm_key_lookup(old_dictionary, old_duplicates, key_length)
+    new_keys = _tgm_key_lookup(new_dictionary, new_duplicates, key_length)
+
+    # keys whose definition differs make even byte-identical columns changed
+    changed_keys = set()
+    for key in old_keys.keys() | new_keys.keys():
+        old_key = old_keys.get(key)
+        new_key = new_keys.get(key)
+        if old_key is None or new_key is None or old_dictionary[old_key] != new_dictionary[new_key]:
+            changed_keys.add(key)
+
+    maxx = max(x for x, z in old_columns)
+    maxz = max(z for x, z in old_columns)
+    maxy = next(iter(old_columns.values())).count("\n") + 1
+    if len(old_columns) != maxx * maxz:
+        return None
+
+    diffed_dmm = None
+    if not stats_only:
+        diffed_dmm = DMM(key_length, Coordinate(maxx, maxy, maxz))
+        diffed_dmm.dictionary = old_dictionary.copy()
+        diffed_grid = diffed_dmm.grid
+    old_grid = {}
+    new_grid = {}
+    changed_coords = []
+    # stats only: (old key, new key) -> tiles, for the changed columns
+    key_pairs = Counter()
+
+    try:
+        for (x, z), old_column in old_columns.items():
+            old_column_keys = old_column.split("\n")
+            if len(old_column_keys) != maxy:
+                return None
+            new_column = new_columns[x, z]
+            if old_column == new_column and changed_keys.isdisjoint(old_column_keys):
+                # unchanged: only the diffed map needs to know about it
+                if not stats_only:
+                    for i, key in enumerate(old_column_keys):
+                        diffed_grid[x, maxy - i, z] = old_keys[key]
+                continue
+            new_column_keys = new_column.split("\n")
+            if len(new_column_keys) != maxy:
+                return None
+            if stats_only:
+                key_pairs.update(zip(old_column_keys, new_column_keys))
+                continue
+            for i in range(maxy):
+                coord = x, maxy - i, z
+                old_grid[coord] = old_keys[old_column_keys[i]]
+                new_grid[coord] = new_keys[new_column_keys[i]]
+                changed_coords.append(coord)
+    except KeyError:
+        return None
+
+    if stats_only:
+        try:
+            key_pairs = Counter({(old_keys[old_key], new_keys[new_key]): count for (old_key, new_key), count in key_pairs.items()})
+        except KeyError:
+            return None
+        old_groups = atoms.dictionary_groups({old_key: old_dictionary[old_key] for old_key, _ in key_pairs})
+        new_groups = atoms.dictionary_groups({new_key: new_dictionary[new_key] for _, new_key in key_pairs})
+        tiles_changed, movables_added, movables_deleted, turfs_changed, areas_changed = count_changes(key_pairs, old_groups, new_groups, atoms, varedits)
+    else:
+        changed_old_keys = set(old_grid.values())
+        changed_new_keys = set(new_grid.values())
+        old_groups = atoms.dictionary_groups({key: old_dictionary[key] for key in changed_old_keys})
+        new_groups = atoms.dictionary_groups({key: new_dictionary[key] for key in changed_new_keys})
+        tiles_changed, movables_added, movables_deleted, turfs_changed, areas_changed = \
+            diff_tiles(changed_coords, old_grid, new_grid, old_groups, new_groups, atoms, diffed_dmm, varedits)
+    note = "No visible changes" if tiles_changed == 0 else None
+    return tiles_changed, diffed_dmm, note, movables_added, movables_deleted, turfs_changed, areas_changed, filename
+
+def estimate_diff_memory(old_text, new_text):
+    # both parsed maps; the diffed map reuses the old dictionary and is covered by the slack in the parse estimates
+    return estimate_parse_memory(old_text) + estimate_parse_memory(new_text)
+
+def create_diff_from_text(old_text, new_text, filename, atoms=None, stats_only=False, varedits=False, workers=1):
+    # TGM maps are compared column by column first, so only columns that differ get decoded
+    # maps that do need a full parse are split across `workers` processes
+    if atoms is None:
+        atoms = AtomTable()
+    old_split = split_tgm_columns(old_text)
+    new_split = split_tgm_columns(new_text) if old_split is not None else None
+    if new_split is not None:
+        result = _create_tgm_column_diff(old_split, new_split, filename, atoms, stats_only, varedits)
+        if result is not None:
+            return result
+    return create_diff(_parse(old_text, atoms, workers), _parse(new_text, atoms, workers), filename, atoms, stats_only, varedits)
+
+# ----------
+# Batch diffing
+
+def find_modified_maps_in_dirs(old_dir, new_dir):
+    # relative paths of .dmm files present in both directories with different contents
+    modified = []
+    for root, dirs, files in os.walk(old_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith(".dmm"):
+                continue
+            old_path = os.path.join(root, name)
+            path = os.path.relpath(old_path, old_dir)
+            new_path = os.path.join(new_dir, path)
+            if os.path.isfile(new_path) and not filecmp.cmp(old_path, new_path, shallow=False):
+                modified.append(path)
+    return modified
+
+def find_modified_maps_in_git(repo, before, after):
+    output = subprocess.run(["git", "-C", repo, "diff", "--name-status", "-z", "--no-renames", before, after, "--", "*.dmm"],
+        check=True, capture_output=True).stdout.decode(ENCODING)
+    fields = output.split("\0")
+    return [path for status, path in zip(fields[0::2], fields[1::2]) if status == "M"]
+
+def read_git_blob(repo, ref, path):
+    return subprocess.run(["git", "-C", repo, "show", f"{ref}:{path}"], check=True, capture_output=True).stdout.decode(ENCODING)
+
+def _batch_diff_one(job):
+    # runs in a worker process, so everything it needs is passed in and only plain values are returned
+    path, load_old, load_new, out_path, varedits = job
+    start = time.perf_counter()
+    try:
+        old_text = load_old[0](*load_old[1:])
+        new_text = load_new[0](*load_new[1:])
+        tiles_changed, diff_dmm, note, movables_added, movables_deleted, turfs_changed, areas_changed, _ = \
+            create_diff_from_text(old_text, new_text, path, varedits=varedits)
+        if tiles_changed > 0:
+            os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+            diff_dmm.to_file(out_path)
+        else:
+            out_path = None
+    except Exception as e:
+        return path, 0, f"Error: {e}", 0, 0, 0, 0, time.perf_counter() - start, None
+    return path, tiles_changed, note, movables_added, movables_deleted, turfs_changed, areas_changed, time.perf_counter() - start, out_path
+
+def _read_text(path):
+    with open(path, 'r', encoding=ENCODING) as f:
+        return f.read()
+
+def batch_diff(jobs, workers=None):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_batch_diff_one, jobs))
+
+def print_batch_summary(results, elapsed):
+    headers = ("Map", "Tiles", "Added", "Deleted", "Turfs", "Areas", "Seconds", "Note")
+    rows = [(path, str(tiles), str(added), str(deleted), str(turfs), str(areas), f"{seconds:.2f}", note or "")
+        for path, tiles, note, added, deleted, turfs, areas, seconds, _ in sorted(results, key=lambda result: result[1], reverse=True)]
+    totals = [sum(result[i] for result in results) for i in (1, 3, 4, 5, 6, 7)]
+    rows.append((f"Total ({len(results)} maps, {elapsed:.2f}s wall)", *(str(total) for total in totals[:5]), f"{totals[5]:.2f}", ""))
+    widths = [max(len(row[i]) for row in rows + [headers]) for i in range(len(headers))]
+    for row in [headers, tuple("-" * width for width in widths)] + rows:
+        print("  ".join(cell.ljust(width) if i in (0, 7) else cell.rjust(width) for i, (cell, width) in enumerate(zip(row, widths))).rstrip())
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="diff.py", description="Generate map diffs for one pair of maps, two directories, or two git refs.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--dirs", action="store_true", help="diff every modified .dmm between OLD and NEW directories into OUT (default diffs/)")
+    mode.add_argument("--git", metavar="REPO", help="diff every modified .dmm in REPO between refs OLD and NEW into OUT (default diffs/)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes for batch diffs, or for parsing a single pair of maps (default: CPU count)")
+    parser.add_argument("--varedits", action="store_true", help="mark only the changed vars of edited movables, instead of listing every old and new movable")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("out", nargs="?")
+    args = parser.parse_args(argv)
+
+    if not args.dirs and not args.git:
+        # python diff.py old.dmm new.dmm diff.dmm
+        tiles_changed, diff_dmm, note, movables_added, movables_deleted, turfs_changed, areas_changed, _ = \
+            create_diff_from_text(_read_text(args.old), _read_text(args.new), args.old, varedits=args.varedits, workers=args.jobs or os.cpu_count() or 1)
+        if not note is None:
+            print(note)
+        print(f"{tiles_changed} tiles changed")
+        print(f"{movables_added} movables added, {movables_deleted} movables deleted")
+        print(f"{turfs_changed} turfs changed")
+        print(f"{areas_changed} areas changed")
+        if tiles_changed > 0:
+            out_path = args.out or "diff.dmm"
+            diff_dmm.to_file(out_path)
+            print(f"Diff saved to: {out_path}")
+        return 0
+
+    out_dir = args.out or "diffs"
+    if args.dirs:
+        paths = find_modified_maps_in_dirs(args.old, args.new)
+        jobs = [(path, (_read_text, os.path.join(args.old, path)), (_read_text, os.path.join(args.new, path)), os.path.join(out_dir, path), args.varedits)
+            for path in paths]
+    else:
+        paths = find_modified_maps_in_git(args.git, args.old, args.new)
+        jobs = [(path, (read_git_blob, args.git, args.old, path), (read_git_blob, args.git, args.new, path), os.path.join(out_dir, path), args.varedits)
+            for path in paths]
+    if not jobs:
+        print("No maps changed")
+        return 0
+    start = time.perf_counter()
+    results = batch_diff(jobs, args.jobs)
+    print_batch_summary(results, time.perf_counter() - start)
+    print(f"Diffs saved to: {out_dir}")
+    return 1 if any(result[2] and result[2].startswith("Error: ") for result in results) else 0
+
 if __name__ == "__main__":
-    # python diff.py old.dmm new.dmm diff.dmm
-    before = DMM.from_file(sys.argv[1])
-    after = DMM.from_file(sys.argv[2])
-    tiles_changed, diff_dmm, note, movables_added, movables_deleted, turfs_changed, areas_changed  = create_diff(before, after)
-    if not note is None:
-        print(note)
-    print(f"{tiles_changed} tiles changed")
-    print(f"{movables_added} movables added, {movables_deleted} movables deleted")
-    print(f"{turfs_changed} turfs changed")
-    print(f"{areas_changed} areas changed")
-    if tiles_changed > 0:
-        out_path = "diff.dmm" if len(sys.argv) < 4 else sys.argv[3]
-        diff_dmm.to_file(out_path)
-        print(f"Diff saved to: {out_path}")
-        
\ No newline at end of file
+    sys.exit(main(sys.argv[1:]))
@@ -3,9 +3,16 @@
 # Tools for working with DreamMaker maps
 
 import io
+import re
+import sys
+import mmap
+import array
+import struct
 import bidict
 import random
-from collections import namedtuple
+import itertools
+import concurrent.futures
+from collections import namedtuple, Counter
 import gzip
 
 TGM_HEADER = "//MAP CONVERTED BY dmm2tgm.py THIS HEADER COMMENT PREVENTS RECONVERSION, DO NOT REMOVE"
@@ -24,13 +31,23 @@ class DMM:
         self.header = None
 
     @staticmethod
-    def from_file(fname):
+    def from_file(fname, atoms=None, workers=1):
         with open(fname, 'r', encoding=ENCODING) as f:
-            return _parse(f.read())
+            return _parse(f.read(), atoms, workers)
 
     @staticmethod
-    def from_bytes(bytes):
-        return _parse(bytes.decode(ENCODING))
+    def from_bytes(bytes, atoms=None, workers=1):
+        return _parse(bytes.decode(ENCODING), atoms, workers)
+
+    @staticmethod
+    def from_snapshot(fname, atoms=None):
+        with Snapshot.open(fname) as snapshot:
+            return snapshot.to_dmm(atoms)
+
+    @staticmethod
+    def from_snapshot_bytes(bytes, atoms=None):
+        with Snapshot(bytes) as snapshot:
+            return snapshot.to_dmm(atoms)
 
     def to_file(self, fname, *, tgm = True, do_gzip = False):
         self._presave_checks()
@@ -49,6 +66,15 @@ class DMM:
             f.flush()
             return bio.getvalue()
 
+    def to_snapshot(self, fname):
+        with open(fname, 'wb') as f:
+            save_snapshot(self, f)
+
+    def to_snapshot_bytes(self):
+        bio = io.BytesIO()
+        save_snapshot(self, bio)
+        return bio.getvalue()
+
     def get_or_generate_key(self, tile):
         try:
             return self.dictionary.inv[tile]
@@ -262,6 +288,83 @@ def fix_atom_ordering(atoms):
     movables.extend(areas)
     return movables
 
+# ----------
+# Interned atoms
+
+ATOM_MOVABLE = 0
+ATOM_TURF = 1
+ATOM_AREA = 2
+
+def classify_atom(atom):
+    if atom.startswith('/turf'):
+        return ATOM_TURF
+    elif atom.startswith('/area'):
+        return ATOM_AREA
+    return ATOM_MOVABLE
+
+# A dictionary entry with its atoms split into groups of atom IDs, plus the multiset of movable IDs
+TileGroups = namedtuple('TileGroups', ['tile', 'movables', 'turfs', 'areas', 'movable_counts'])
+
+class AtomTable:
+    """Shared intern table assigning integer IDs to atom strings.
+
+    Each atom is classified once when first seen, and each distinct tile tuple is split into
+    its (movables, turfs, areas) groups once, so that several maps can share the work.
+    Atoms are only run through parse_map_atom when asked for, and then once.
+    """
+    __slots__ = ['ids', 'atoms', 'kinds', 'groups', 'parsed']
+
+    def __init__(self):
+        self.ids = {}
+        self.atoms = []
+        self.kinds = []
+        self.groups = {}
+        self.parsed = {}
+
+    def intern(self, atom):
+        try:
+            return self.ids[atom]
+        except KeyError:
+            atom_id = self.ids[atom] = len(self.atoms)
+            self.atoms.append(atom)
+            self.kinds.append(classify_atom(atom))
+            return atom_id
+
+    def canonical(self, atom):
+        return self.atoms[self.intern(atom)]
+
+    def strings(self, atom_ids):
+        atoms = self.atoms
+        return [atoms[i] for i in atom_ids]
+
+    def parse(self, atom_id):
+        # (path, vars) of an interned atom
+        try:
+            return self.parsed[atom_id]
+        except KeyError:
+            parsed = self.parsed[atom_id] = parse_map_atom(self.atoms[atom_id])
+            return parsed
+
+    def tile_groups(self, tile):
+        try:
+            return self.groups[tile]
+        except KeyError:
+            pass
+        kinds = self.kinds
+        atom_ids = [self.intern(atom) for atom in tile]
+        split = ([], [], [])
+        for atom_id in atom_ids:
+            split[kinds[atom_id]].append(atom_id)
+        movables, turfs, areas = split
+        groups = TileGroups(tuple(self.strings(atom_ids)), tuple(movables), tuple(turfs), tuple(areas), Counter(movables))
+        self.groups[groups.tile] = groups
+        return groups
+
+    def dictionary_groups(self, dictionary):
+        # map every key of a DMM dictionary to its precomputed groups
+        tile_groups = self.tile_groups
+        return {key: tile_groups(tile) for key, tile in dictionary.items()}
+
 # ----------
 # TGM writer
 
@@ -338,10 +441,178 @@ def save_dmm(dmm, output):
             output.write("\n")
         output.write("\"}\n")
 
+# ----------
+# Binary snapshots
+#
+# A parsed map, saved so it can be loaded again without parsing any text. All integers are
+# little-endian 32 bit, and every section starts 4 byte aligned:
+#   header      magic, version, key length, size x/y/z, atom count, dictionary entry count,
+#               atom reference count, map header byte length
+#   map header  UTF-8 (DMM.header), padded
+#   atoms       atom count + 1 byte offsets into the string data, then the UTF-8 string data, padded
+#   dictionary  entry keys, entry count + 1 offsets into the references, then the atom references
+#   grid        the key of every tile, in x, y, z order (z changing fastest)
+
+SNAPSHOT_MAGIC = b"MDBSNAP\0"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sIIIIIIIII")
+
+class SnapshotError(Exception):
+    pass
+
+def _uint32_array(values=()):
+    # array typecode with 4 byte items, which is platform dependent
+    return array.array('I' if array.array('I').itemsize == 4 else 'L', values)
+
+def _write_uint32s(output, values):
+    values = values if isinstance(values, array.array) else _uint32_array(values)
+    if sys.byteorder != "little":
+        values = _uint32_array(values)
+        values.byteswap()
+    output.write(values.tobytes())
+
+def _write_padded(output, data):
+    output.write(data)
+    output.write(b"\0" * (-len(data) % 4))
+
+def save_snapshot(dmm, output):
+    atom_indexes = {}
+    keys = sorted(dmm.dictionary.keys())
+    entry_offsets = [0]
+    references = _uint32_array()
+    for key in keys:
+        for atom in dmm.dictionary[key]:
+            try:
+                references.append(atom_indexes[atom])
+            except KeyError:
+                references.append(atom_indexes.setdefault(atom, len(atom_indexes)))
+        entry_offsets.append(len(references))
+    encoded_atoms = [atom.encode(ENCODING) for atom in atom_indexes]
+    string_offsets = [0]
+    for encoded in encoded_atoms:
+        string_offsets.append(string_offsets[-1] + len(encoded))
+    map_header = (dmm.header or "").encode(ENCODING)
+
+    max_x, max_y, max_z = dmm.size
+    grid = dmm.grid
+    output.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, dmm.key_length, max_x, max_y, max_z,
+        len(encoded_atoms), len(keys), len(references), len(map_header)))
+    _write_padded(output, map_header)
+    _write_uint32s(output, string_offsets)
+    _write_padded(output, b"".join(encoded_atoms))
+    _write_uint32s(output, keys)
+    _write_uint32s(output, entry_offsets)
+    _write_uint32s(output, references)
+    _write_uint32s(output, map(grid.__getitem__, itertools.product(range(1, max_x + 1), range(1, max_y + 1), range(1, max_z + 1))))
+
+class Snapshot:
+    """A map snapshot read in place from a buffer, usually a memory-mapped file.
+
+    Atom strings are only decoded when a dictionary entry using them is first asked for, and
+    each is decoded once. `to_dmm` builds a full DMM, which is what most code works with.
+    """
+
+    def __init__(self, buffer, mapped=None):
+        self.mapped = mapped
+        view = memoryview(buffer)
+        if len(view) < SNAPSHOT_HEADER.size:
+            raise SnapshotError("not a map snapshot")
+        magic, version, self.key_length, max_x, max_y, max_z, atom_count, entry_count, reference_count, header_length = \
+            SNAPSHOT_HEADER.unpack_from(view)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError("not a map snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(f"unsupported map snapshot version {version}")
+        self.size = Coordinate(max_x, max_y, max_z)
+
+        offset = SNAPSHOT_HEADER.size
+        self.header = bytes(view[offset:offset + header_length]).decode(ENCODING) or None
+        offset += header_length + (-header_length % 4)
+        self.string_offsets, offset = self._uint32s(view, offset, atom_count + 1)
+        self.strings = view[offset:offset + self.string_offsets[-1]]
+        offset += self.string_offsets[-1] + (-self.string_offsets[-1] % 4)
+        self.keys, offset = self._uint32s(view, offset, entry_count)
+        self.entry_offsets, offset = self._uint32s(view, offset, entry_count + 1)
+        self.references, offset = self._uint32s(view, offset, reference_count)
+        self.grid, offset = self._uint32s(view, offset, max_x * max_y * max_z)
+        self.atoms = [None] * atom_count
+        self.key_indexes = None
+        self.view = view
+
+    @staticmethod
+    def _uint32s(view, offset, count):
+        end = offset + 4 * count
+        if end > len(view):
+            raise SnapshotError("truncated map snapshot")
+        section = view[offset:end]
+        if sys.byteorder == "little" and _uint32_array().typecode == 'I':
+            return section.cast('I'), end
+        values = _uint32_array()
+        values.frombytes(section)
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values, end
+
+    @staticmethod
+    def open(fname):
+        with open(fname, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return Snapshot(mapped, mapped)
+
+    def atom(self, index):
+        atom = self.atoms[index]
+        if atom is None:
+            atom = self.atoms[index] = str(self.strings[self.string_offsets[index]:self.string_offsets[index + 1]], ENCODING)
+        return atom
+
+    def entry(self, index):
+        # the tile of the index'th dictionary entry
+        atom = self.atom
+        return tuple(atom(reference) for reference in self.references[self.entry_offsets[index]:self.entry_offsets[index + 1]])
+
+    def tile(self, key):
+        if self.key_indexes is None:
+            self.key_indexes = {key: index for index, key in enumerate(self.keys)}
+        return self.entry(self.key_indexes[key])
+
+    def key_at(self, coord):
+        # reads one tile's key straight from the grid, without building a DMM
+        x, y, z = coord
+        return self.grid[((x - 1) * self.size.y + y - 1) * self.size.z + z - 1]
+
+    def to_dmm(self, atoms=None):
+        # if an AtomTable is given, atoms are interned into it like _parse does
+        dmm = DMM(self.key_length, self.size)
+        dmm.header = self.header
+        if atoms is not None:
+            for index in range(len(self.atoms)):
+                self.atoms[index] = atoms.canonical(self.atom(index))
+        dmm.dictionary = bidict.bidict(zip(self.keys.tolist(), map(self.entry, range(len(self.keys)))))
+        max_x, max_y, max_z = self.size
+        dmm.grid = dict(zip(itertools.product(range(1, max_x + 1), range(1, max_y + 1), range(1, max_z + 1)), self.grid.tolist()))
+        return dmm
+
+    def close(self):
+        # views into the buffer must be released before the mapping can be closed
+        for view in (self.string_offsets, self.strings, self.keys, self.entry_offsets, self.references, self.grid, self.view):
+            if isinstance(view, memoryview):
+                view.release()
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 # ----------
 # Parser
 
-def _parse(map_raw_text):
+def _parse_dictionary(it, atoms=None):
+    # consumes the dictionary section from a character iterator, stopping at the first coordinate block
+    # if an AtomTable is given, dictionary atoms are interned into it so maps parsed together share strings
     in_comment_line = False
     comment_trigger = False
 
@@ -360,28 +631,10 @@ def _parse(map_raw_text):
     curr_datum = ""
     curr_data = list()
 
-    in_map_block = False
     in_coord_block = False
-    in_map_string = False
-    iter_x = 0
-    adjust_y = True
-
-    curr_num = ""
-    reading_coord = "x"
 
     key_length = 0
 
-    maxx = 0
-    maxy = 0
-    maxz = 0
-
-    curr_x = 0
-    curr_y = 0
-    curr_z = 0
-    grid = dict()
-
-    it = iter(map_raw_text)
-
     # map block
     for char in it:
         if char == "\n":
@@ -453,7 +706,10 @@ def _parse(map_raw_text):
 
             elif char == ")":
                 curr_data.append(curr_datum)
-                curr_data = tuple(curr_data)
+                if atoms is not None:
+                    curr_data = tuple(atoms.canonical(atom) for atom in curr_data)
+                else:
+                    curr_data = tuple(curr_data)
                 try:
                     dictionary[curr_key] = curr_data
                 except bidict.ValueDuplicationError:
@@ -488,14 +744,35 @@ def _parse(map_raw_text):
         elif char == "(":
             if after_data_block:
                 in_coord_block = True
-                after_data_block = False
-                curr_key = 0
-                curr_key_len = 0
                 break
             else:
                 in_data_block = True
                 after_data_block = False
 
+    return dictionary, duplicate_keys, key_length, in_coord_block
+
+def _parse_grid(it, key_length, duplicate_keys, in_coord_block):
+    # consumes coordinate blocks from a character iterator
+    # returns the grid in raw .dmm coordinates, the maximums seen, and the y the last block ended on
+    curr_key_len = 0
+    curr_key = 0
+
+    in_map_string = False
+    iter_x = 0
+    adjust_y = True
+
+    curr_num = ""
+    reading_coord = "x"
+
+    maxx = 0
+    maxy = 0
+    maxz = 0
+
+    curr_x = 0
+    curr_y = 0
+    curr_z = 0
+    grid = dict()
+
     # grid block
     for char in it:
         if char == "\r":
@@ -565,6 +842,20 @@ def _parse(map_raw_text):
         elif char == "\"":
             in_map_string = True
 
+    return grid, maxx, maxy, maxz, curr_y
+
+def _parse(map_raw_text, atoms=None, workers=1):
+    # with more than one worker, the grid's coordinate blocks are split across processes
+    if workers > 1:
+        data = _parse_parallel(map_raw_text, atoms, workers)
+        if data is not None:
+            return data
+    it = iter(map_raw_text)
+    dictionary, duplicate_keys, key_length, in_coord_block = _parse_dictionary(it, atoms)
+    grid, maxx, maxy, maxz, curr_y = _parse_grid(it, key_length, duplicate_keys, in_coord_block)
+    return _finish_parse(dictionary, key_length, grid, maxx, maxy, maxz, curr_y)
+
+def _finish_parse(dictionary, key_length, grid, maxx, maxy, maxz, curr_y):
     if curr_y > maxy:
         maxy = curr_y
 
@@ -582,3 +873,93 @@ def _parse(map_raw_text):
     data.dictionary = dictionary
     data.grid = grid2
     return data
+
+# ----------
+# Parallel parsing
+
+# Start of a coordinate block, like (1,1,1) = {"
+COORD_BLOCK_RE = re.compile(r'^\(\d+,\d+,\d+\) = \{"', re.MULTILINE)
+# Chunks made per worker, so one slow chunk doesn't hold up the rest
+PARSE_CHUNKS_PER_WORKER = 4
+# Smaller maps parse faster than worker processes start
+PARALLEL_PARSE_MIN_LENGTH = 1024 * 1024
+
+def _parse_grid_chunk(job):
+    # runs in a worker process; the grid comes back as flat arrays, which pickle far smaller than a dict of tuples
+    text, key_length, duplicate_keys = job
+    grid, maxx, maxy, maxz, curr_y = _parse_grid(iter(text), key_length, duplicate_keys, False)
+    xs, ys, zs = (_uint32_array(coord[i] for coord in grid) for i in range(3))
+    return xs, ys, zs, _uint32_array(grid.values()), maxx, maxy, maxz, curr_y
+
+def split_coord_blocks(map_raw_text, chunks):
+    # splits a map into its dictionary text and up to `chunks` runs of whole coordinate blocks of similar size
+    starts = [match.start() for match in COORD_BLOCK_RE.finditer(map_raw_text)]
+    if not starts:
+        return map_raw_text, []
+    target = (len(map_raw_text) - starts[0]) / max(1, chunks)
+    bounds = [starts[0]]
+    for start in starts[1:]:
+        if start - bounds[-1] >= target:
+            bounds.append(start)
+    bounds.append(len(map_raw_text))
+    return map_raw_text[:starts[0]], [map_raw_text[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+def _parse_parallel(map_raw_text, atoms, workers):
+    # returns None when the map is too small to split, so it's parsed normally
+    if len(map_raw_text) < PARALLEL_PARSE_MIN_LENGTH:
+        return None
+    dictionary_text, chunks = split_coord_blocks(map_raw_text, workers * PARSE_CHUNKS_PER_WORKER)
+    if len(chunks) < 2:
+        return None
+    dictionary, duplicate_keys, key_length, _ = _parse_dictionary(iter(dictionary_text), atoms)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        results = list(executor.map(_parse_grid_chunk, [(chunk, key_length, duplicate_keys) for chunk in chunks]))
+
+    # stitched in text order, so later blocks overwrite earlier ones and the last block's y counts, like _parse
+    grid = {}
+    for xs, ys, zs, keys, _, _, _, _ in results:
+        grid.update(zip(zip(xs, ys, zs), keys))
+    maxx = max(result[4] for result in results)
+    maxy = max(result[5] for result in results)
+    maxz = max(result[6] for result in results)
+    return _finish_parse(dictionary, key_length, grid, maxx, maxy, maxz, results[-1][7])
+
+# ----------
+# TGM column blocks
+
+TGM_COLUMN_RE = re.compile(r'^\((\d+),1,(\d+)\) = \{"\n(.*?)\n"\}$', re.MULTILINE | re.DOTALL)
+
+def split_tgm_columns(map_raw_text):
+    # splits a TGM map into its dictionary text and a {(x, z): column text} dict without parsing either
+    # returns None if the map isn't in TGM format
+    if not map_raw_text.startswith(TGM_HEADER):
+        return None
+    text = map_raw_text.replace("\r", "")
+    first = TGM_COLUMN_RE.search(text)
+    if first is None:
+        return None
+    columns = {}
+    for match in TGM_COLUMN_RE.finditer(text, first.start()):
+        columns[int(match.group(1)), int(match.group(2))] = match.group(3)
+    return text[:first.start()], columns
+
+# ----------
+# Memory estimates
+
+# Rough sizes of the Python objects _parse creates, measured with tracemalloc
+PARSE_MEMORY_PER_TILE = 240
+PARSE_MEMORY_PER_DICTIONARY_BYTE = 4
+
+KEY_DEFINITION_RE = re.compile(r'^"([a-zA-Z]+)" = \(', re.MULTILINE)
+
+def estimate_parse_memory(map_raw_text):
+    # estimates the bytes needed to hold the text and its parsed DMM, without parsing it
+    grid_start = map_raw_text.find("\n(")
+    if grid_start == -1:
+        grid_start = len(map_raw_text)
+    key = KEY_DEFINITION_RE.search(map_raw_text, 0, grid_start)
+    key_length = len(key.group(1)) if key else 1
+    # TGM puts each key on its own line, DMM only ends each row with a newline
+    bytes_per_tile = key_length + 1 if map_raw_text.startswith(TGM_HEADER) else key_length
+    tiles = (len(map_raw_text) - grid_start) // bytes_per_tile
+    return len(map_raw_text) + grid_start * PARSE_MEMORY_PER_DICTIONARY_BYTE + tiles * PARSE_MEMORY_PER_TILE
@@ -0,0 +1,329 @@
+# Load test harness: replays signed pull_request webhooks against the server, backed by a local stand-in for GitHub
+#
+# python -m MapDiffBot-DMM.loadtest --prs 20 --rate 2 --maps 3
+
+import os
+import re
+import sys
+import json
+import logging
+import hmac
+import time
+import random
+import hashlib
+import resource
+import argparse
+import tempfile
+import threading
+import urllib.parse
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+from .dmm import DMM, Coordinate
+
+# ----------
+# Synthetic maps
+
+TURFS = ["/turf/open/floor/plasteel", "/turf/open/floor/wood", "/turf/closed/wall", "/turf/closed/wall/r_wall", "/turf/open/space"]
+AREAS = ["/area/space", "/area/hallway/primary", "/area/maintenance", "/area/engine", "/area/medical"]
+MOVABLES = [
+    "/obj/item/pen",
+    "/obj/structure/table",
+    "/obj/structure/chair{dir = 4}",
+    '/obj/machinery/door/airlock{name = "Airlock"}',
+    "/obj/machinery/light{dir = 1}",
+    "/obj/effect/spawner/random",
+    "/obj/structure/cable{icon_state = \"1-2\"}",
+    "/mob/living/simple_animal/mouse",
+]
+
+def random_tile(rng):
+    return tuple(rng.choice(MOVABLES) for _ in range(rng.randint(0, 3))) + (rng.choice(TURFS), rng.choice(AREAS))
+
+def synthetic_map(seed, size, palette_size=400):
+    rng = random.Random(seed)
+    dmm = DMM(2, size)
+    palette = [dmm.get_or_generate_key(random_tile(rng)) for _ in range(palette_size)]
+    for z in range(1, size.z + 1):
+        for y in range(1, size.y + 1):
+            for x in range(1, size.x + 1):
+                dmm.grid[x, y, z] = rng.choice(palette)
+    return dmm
+
+def mutate_map(dmm, seed, changes):
+    # changes random tiles in place, in clusters like a real mapping PR
+    rng = random.Random(seed)
+    while changes > 0:
+        cx, cy, z = rng.randint(1, dmm.size.x), rng.randint(1, dmm.size.y), rng.randint(1, dmm.size.z)
+        for _ in range(min(changes, rng.randint(1, 20))):
+            coord = (min(dmm.size.x, max(1, cx + rng.randint(-3, 3))), min(dmm.size.y, max(1, cy + rng.randint(-3, 3))), z)
+            dmm.set_tile(coord, random_tile(rng))
+            changes -= 1
+    return dmm
+
+# ----------
+# Fake GitHub
+
+def fake_sha(*parts):
+    return hashlib.sha1("-".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+class FakeGitHub:
+    """Serves the GitHub endpoints do_request uses, counting every call.
+
+    Pull requests are registered up front, so their maps are generated before timing starts.
+    Check runs are tracked by head SHA, and `wait_completed` returns when each was given a conclusion.
+    """
+
+    def __init__(self, size, changes):
+        self.size = size
+        self.changes = changes
+        self.lock = threading.Condition()
+        self.calls = Counter()
+        # (path, ref) -> map text
+        self.contents = {}
+        # (full_name, base, head) -> [map paths]
+        self.pulls = {}
+        self.check_runs = {}
+        # head sha -> completion time
+        self.completed = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-github", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_pull_request(self, full_name, number, maps):
+        base = fake_sha(full_name, number, "base")
+        head = fake_sha(full_name, number, "head")
+        paths = []
+        for i in range(maps):
+            path = f"_maps/map_files/LoadTest{number}_{i}.dmm"
+            dmm = synthetic_map(fake_sha(full_name, path), self.size)
+            self.contents[path, base] = dmm.to_bytes().decode("utf-8")
+            mutate_map(dmm, fake_sha(full_name, path, number), self.changes)
+            self.contents[path, head] = dmm.to_bytes().decode("utf-8")
+            paths.append(path)
+        self.pulls[full_name, base, head] = paths
+        return base, head
+
+    def wait_completed(self, heads, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while not all(head in self.completed for head in heads):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def _check_run(self, full_name, check_run):
+        return dict(check_run, url=f"{self.url}/repos/{full_name}/check-runs/{check_run['id']}")
+
+    def handle(self, method, path, query, body):
+        # returns (endpoint name, status, json or text)
+        match = re.fullmatch(r"/repos/([^/]+/[^/]+)/installation", path)
+        if method == "GET" and match:
+            return "installation", 200, {"id": 1, "app_id": 1}
+        match = re.fullmatch(r"/app/installations/(\d+)/access_tokens", path)
+        if method == "POST" and match:
+            return "access token", 201, {"token": "loadtest-token", "expires_at": "2099-01-01T00:00:00Z"}
+        match = re.fullmatch(r"/repos/([^/]+)/([^/]+)", path)
+        if method == "GET" and match:
+            owner, name = match.groups()
+            return "repository", 200, {"id": 1, "name": name, "full_name": f"{owner}/{name}", "owner": {"login": owner}, "url": f"{self.url}/repos/{owner}/{name}"}
+        match = re.fullmatch(r"/repos/([^/]+/[^/]+)/compare/([0-9a-f]+)\.\.\.([0-9a-f]+)", path)
+        if method == "GET" and match:
+            full_name, base, head = match.groups()
+            paths = self.pulls.get((full_name, base, head))
+            if paths is None:
+                return "compare", 404, {"message": "Not Found"}
+            return "compare", 200, {"status": "ahead", "files": [
+                {"filename": path, "status": "modified", "additions": self.changes, "deletions": self.changes, "changes": self.changes * 2, "sha": fake_sha(path, head)}
+                for path in paths]}
+        match = re.fullmatch(r"/repos/([^/]+/[^/]+)/contents/(.+)", path)
+        if method == "GET" and match:
+            text = self.contents.get((match.group(2), query.get("ref", [""])[0]))
+            if text is None:
+                return "contents", 404, {"message": "Not Found"}
+            return "contents", 200, text
+        match = re.fullmatch(r"/repos/([^/]+/[^/]+)/check-runs", path)
+        if method == "POST" and match:
+            with self.lock:
+                check_run = dict(body, id=len(self.check_runs) + 1)
+                self.check_runs[check_run["id"]] = check_run
+                if "conclusion" in body:
+                    self.completed[check_run["head_sha"]] = time.monotonic()
+                    self.lock.notify_all()
+            return "check run create", 201, self._check_run(match.group(1), check_run)
+        match = re.fullmatch(r"/repos/([^/]+/[^/]+)/check-runs/(\d+)", path)
+        if method == "PATCH" and match:
+            with self.lock:
+                check_run = self.check_runs[int(match.group(2))]
+                check_run.update(body)
+                if "conclusion" in body:
+                    self.completed[check_run["head_sha"]] = time.monotonic()
+                    self.lock.notify_all()
+            return "check run edit", 200, self._check_run(match.group(1), check_run)
+        return "unknown", 404, {"message": "Not Found"}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def respond(self, method):
+                url = urllib.parse.urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+                endpoint, status, result = fake.handle(method, urllib.parse.unquote(url.path), urllib.parse.parse_qs(url.query), body)
+                with fake.lock:
+                    fake.calls[endpoint] += 1
+                data = (result if isinstance(result, str) else json.dumps(result)).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain" if isinstance(result, str) else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("X-RateLimit-Remaining", "5000")
+                self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.respond("GET")
+
+            def do_POST(self):
+                self.respond("POST")
+
+            def do_PATCH(self):
+                self.respond("PATCH")
+
+        return Handler
+
+# ----------
+# Harness
+
+def write_config(directory, fake, args):
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives import serialization
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    key_path = os.path.join(directory, "private_key.pem")
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")) as f:
+        config = json.load(f)
+    config.update({
+        "app-id": "1",
+        "app-key-path": key_path,
+        "host": "http://127.0.0.1",
+        "webhook-secret": args.secret,
+        "github-api-url": fake.url,
+        "dmm-save-path": os.path.join(directory, "dmms"),
+        "git-mirror-path": "",
+        "banned-repos": [],
+        "banned-users": [],
+        "check-run-update-interval": args.update_interval,
+    })
+    config_file = os.path.join(directory, "config.json")
+    with open(config_file, "w") as f:
+        json.dump(config, f)
+    return config_file
+
+def send_webhook(url, secret, payload, results):
+    data = json.dumps(payload).encode("utf-8")
+    signature = hmac.new(secret.encode("utf-8"), msg=data, digestmod=hashlib.sha1).hexdigest()
+    start = time.monotonic()
+    response = requests.post(url, data=data, headers={"Content-Type": "application/json", "X-GitHub-Event": "pull_request", "X-Hub-Signature": f"sha1={signature}"})
+    results[payload["pull_request"]["head"]["sha"]] = (start, time.monotonic(), response.status_code)
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def run(args):
+    fake = FakeGitHub(Coordinate(*args.size), args.changes)
+    pulls = []
+    print(f"Generating {args.prs} pull requests with {args.maps} maps each...", file=sys.stderr)
+    for number in range(1, args.prs + 1):
+        full_name = f"loadtest/repo{number % args.repos}"
+        base, head = fake.add_pull_request(full_name, number, args.maps)
+        pulls.append((number, full_name, base, head))
+    fake.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["MDB_CONFIG"] = write_config(directory, fake, args)
+        # the server reads its config on import, so it can only be imported once the stand-in is up
+        from . import server
+        from werkzeug.serving import make_server
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        http_server = make_server("127.0.0.1", 0, server.app, threaded=True)
+        threading.Thread(target=http_server.serve_forever, name="mdb-server", daemon=True).start()
+        webhook_url = f"http://127.0.0.1:{http_server.server_port}{server.webhook_path}"
+
+        sent = {}
+        senders = []
+        start = time.monotonic()
+        for i, (number, full_name, base, head) in enumerate(pulls):
+            # open loop: webhooks go out on schedule whether or not earlier ones were handled
+            time.sleep(max(0, start + i / args.rate - time.monotonic()))
+            owner, name = full_name.split("/")
+            payload = {
+                "action": "opened",
+                "pull_request": {"id": number, "number": number, "title": f"Load test {number}", "head": {"sha": head}, "base": {"sha": base}},
+                "repository": {"owner": {"login": owner}, "name": name, "full_name": full_name},
+            }
+            sender = threading.Thread(target=send_webhook, args=(webhook_url, args.secret, payload, sent), daemon=True)
+            sender.start()
+            senders.append(sender)
+        heads = [head for _, _, _, head in pulls]
+        finished = fake.wait_completed(heads, args.timeout)
+        for sender in senders:
+            sender.join(max(0, args.timeout - (time.monotonic() - start)))
+        end = time.monotonic()
+        http_server.shutdown()
+    fake.stop()
+
+    completion = [fake.completed[head] - sent[head][0] for head in heads if head in fake.completed and head in sent]
+    response = [sent[head][1] - sent[head][0] for head in heads if head in sent]
+    last_completion = max(fake.completed.values(), default=end)
+    print()
+    print(f"Pull requests:        {len(completion)} of {len(heads)} completed{'' if finished else f' (timed out after {args.timeout}s)'}")
+    print(f"Failed webhooks:      {sum(1 for result in sent.values() if result[2] != 200)}")
+    print(f"Throughput:           {len(completion) / max(last_completion - start, 1e-9):.2f} PRs/s, {len(completion) * args.maps / max(last_completion - start, 1e-9):.2f} maps/s")
+    for label, values in (("Webhook to check run", completion), ("Webhook response", response)):
+        print(f"{label + ':':<22}p50 {percentile(values, 50):.2f}s  p90 {percentile(values, 90):.2f}s  p99 {percentile(values, 99):.2f}s  max {max(values, default=0):.2f}s")
+    print(f"Peak memory:          {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB (whole process, including the stand-in)")
+    print("API calls:")
+    for endpoint, count in sorted(fake.calls.items()):
+        print(f"  {endpoint:<20}{count}")
+    return 0 if finished else 1
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="loadtest.py", description="Replay signed pull_request webhooks against the server with a local stand-in for GitHub.")
+    parser.add_argument("--prs", type=int, default=10, help="pull requests to send (default: 10)")
+    parser.add_argument("--rate", type=float, default=1, help="webhooks per second (default: 1)")
+    parser.add_argument("--maps", type=int, default=2, help="maps changed per pull request (default: 2)")
+    parser.add_argument("--repos", type=int, default=3, help="repositories the pull requests are spread over (default: 3)")
+    parser.add_argument("--size", type=lambda size: tuple(int(n) for n in size.split("x")), default=(100, 100, 1), help="map size as XxYxZ (default: 100x100x1)")
+    parser.add_argument("--changes", type=int, default=200, help="tiles changed per map (default: 200)")
+    parser.add_argument("--update-interval", type=float, default=10, help="check-run-update-interval for the server (default: 10)")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for every check run to complete (default: 600)")
+    parser.add_argument("--secret", default="loadtest", help=argparse.SUPPRESS)
+    return run(parser.parse_args(argv))
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
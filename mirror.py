@@ -0,0 +1,136 @@
+# Local bare mirrors of repositories, used instead of the REST API to list and read changed maps
+
+import os
+import base64
+import threading
+import subprocess
+from collections import namedtuple
+from .dmm import ENCODING
+
+# Mirrors the fields of the compare API's files that do_request uses
+ChangedFile = namedtuple('ChangedFile', ['filename', 'status', 'changes'])
+
+# git diff --name-status letters to compare API statuses
+GIT_STATUSES = {
+    "A": "added",
+    "C": "copied",
+    "D": "removed",
+    "M": "modified",
+    "R": "renamed",
+    "T": "changed",
+}
+
+# Fetched commits are pinned under this, so gc doesn't prune them while they're in use
+PIN_PREFIX = "refs/mdb/"
+
+class MirrorError(Exception):
+    pass
+
+class GitMirror:
+    """A bare clone of one repository, updated with `git fetch` for just the revisions needed.
+
+    Blobs are read through a single long-lived `git cat-file --batch` process instead of one
+    request per file per side. Fetched commits are pinned under refs/mdb/ so gc won't prune them, and
+    beyond `max_pins` (0 is unlimited) the pins of the oldest commits are dropped, letting gc reclaim them.
+    """
+
+    def __init__(self, path, max_pins=0):
+        self.path = path
+        self.max_pins = max_pins
+        self.fetch_lock = threading.Lock()
+        self.cat_file_lock = threading.Lock()
+        self.cat_file = None
+
+    def _git(self, *args, config=(), input=None):
+        # config goes through the environment rather than -c, since argv is visible to every local user
+        env = None
+        if config:
+            env = dict(os.environ, GIT_CONFIG_COUNT=str(len(config)))
+            for i, (key, value) in enumerate(config):
+                env[f"GIT_CONFIG_KEY_{i}"] = key
+                env[f"GIT_CONFIG_VALUE_{i}"] = value
+        process = subprocess.run(["git", "--git-dir", self.path, *args], capture_output=True, env=env, input=input)
+        if process.returncode != 0:
+            raise MirrorError(f"git {args[0]} failed in {self.path}: {process.stderr.decode(ENCODING, 'replace').strip()}")
+        return process.stdout
+
+    def has_commit(self, rev):
+        return subprocess.run(["git", "--git-dir", self.path, "cat-file", "-e", f"{rev}^{{commit}}"], capture_output=True).returncode == 0
+
+    def fetch(self, url, revs, token=None):
+        # only revisions missing from the mirror are fetched; the token never ends up in the mirror's config
+        with self.fetch_lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                subprocess.run(["git", "init", "--bare", "-q", self.path], check=True, capture_output=True)
+            missing = [rev for rev in revs if not self.has_commit(rev)]
+            if missing:
+                config = []
+                if token:
+                    credentials = base64.b64encode(f"x-access-token:{token}".encode(ENCODING)).decode(ENCODING)
+                    config.append(("http.extraHeader", f"Authorization: Basic {credentials}"))
+                self._git("fetch", "--no-tags", "--quiet", url, *(f"{rev}:{PIN_PREFIX}{rev}" for rev in missing), config=config)
+            if self.max_pins > 0:
+                # commits still around after their pin was dropped are pinned again while in use
+                self._git("update-ref", "--stdin", input="".join(f"update {PIN_PREFIX}{rev} {rev}\n" for rev in revs).encode(ENCODING))
+                self.prune_pins(revs)
+
+    def prune_pins(self, keep):
+        # drops the pins of the oldest commits beyond max_pins, except those in keep
+        pins = self._git("for-each-ref", "--sort=-committerdate", "--format=%(refname)", PIN_PREFIX).decode(ENCODING).split()
+        keep = {PIN_PREFIX + rev for rev in keep}
+        stale = [ref for ref in pins[self.max_pins:] if not ref in keep]
+        if stale:
+            self._git("update-ref", "--stdin", input="".join(f"delete {ref}\n" for ref in stale).encode(ENCODING))
+
+    def changed_files(self, before, after, pathspec="*.dmm"):
+        # same comparison as the compare API: after against its merge base with before
+        revs = f"{before}...{after}"
+        changes = {}
+        numstat = self._git("diff", "--numstat", "-z", "--no-renames", revs, "--", pathspec).decode(ENCODING).split("\0")
+        for entry in numstat:
+            if not entry:
+                continue
+            additions, deletions, filename = entry.split("\t", 2)
+            # binary files show "-" for both counts
+            changes[filename] = (int(additions) if additions != "-" else 0) + (int(deletions) if deletions != "-" else 0)
+        fields = self._git("diff", "--name-status", "-z", "--no-renames", revs, "--", pathspec).decode(ENCODING).split("\0")
+        return [ChangedFile(filename, GIT_STATUSES.get(status[:1], status), changes.get(filename, 0))
+            for status, filename in zip(fields[0::2], fields[1::2])]
+
+    def read_blobs(self, requests):
+        # requests are (rev, path) pairs, answered in order by the shared cat-file process
+        results = []
+        with self.cat_file_lock:
+            if self.cat_file is None or self.cat_file.poll() is not None:
+                self.cat_file = subprocess.Popen(["git", "--git-dir", self.path, "cat-file", "--batch"],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            stdin, stdout = self.cat_file.stdin, self.cat_file.stdout
+            try:
+                for rev, path in requests:
+                    stdin.write(f"{rev}:{path}\n".encode(ENCODING))
+                    stdin.flush()
+                    header = stdout.readline().decode(ENCODING).split()
+                    if len(header) != 3 or header[1] != "blob":
+                        raise MirrorError(f"{rev}:{path} is not a blob in {self.path}")
+                    data = stdout.read(int(header[2]))
+                    stdout.read(1)
+                    results.append(data.decode(ENCODING))
+            except:
+                # whatever is left of the reply would be read as the next header, so start a fresh process next time
+                self.cat_file.kill()
+                self.cat_file.wait()
+                self.cat_file = None
+                raise
+        return results
+
+    def get_fileset(self, filename, before, after):
+        before_text, after_text = self.read_blobs([(before, filename), (after, filename)])
+        return (before_text, after_text, filename)
+
+    def close(self):
+        with self.cat_file_lock:
+            if self.cat_file is not None:
+                self.cat_file.stdin.close()
+                self.cat_file.wait()
+                self.cat_file = None
@@ -0,0 +1,143 @@
+# Rate limit aware downloads from the GitHub API
+
+import sys
+import time
+import random
+import threading
+import requests
+from contextlib import contextmanager
+
+# Below this many remaining requests concurrency is cut back, above it concurrency grows
+LOW_REMAINING = 500
+
+class RateLimitError(Exception):
+    pass
+
+class RateLimitPaused(RateLimitError):
+    # the installation is paused for longer than the caller was willing to wait
+    def __init__(self, until):
+        super().__init__(f"rate limited until {until:.0f}")
+        self.until = until
+
+class AdaptiveLimiter:
+    """Limits concurrent requests for one installation, adjusting to GitHub's rate limit headers.
+
+    Concurrency grows by one after each successful request with plenty of quota left, up to `ceiling`,
+    and halves when quota runs low or a secondary rate limit is hit. When quota is exhausted or GitHub
+    asks to back off, new requests are held until the reset or Retry-After time.
+    Only successful responses count towards growing concurrency.
+    """
+
+    def __init__(self, initial, ceiling):
+        self.ceiling = max(1, ceiling)
+        self.limit = max(1, min(initial, self.ceiling))
+        self.in_flight = 0
+        self.paused_until = 0
+        self.condition = threading.Condition()
+
+    def ready(self):
+        # whether a request could start right now
+        with self.condition:
+            return self.paused_until <= time.time() and self.in_flight < self.limit
+
+    @contextmanager
+    def slot(self, max_wait=None):
+        # with max_wait, raises RateLimitPaused instead of waiting out a longer pause
+        with self.condition:
+            while True:
+                pause = self.paused_until - time.time()
+                if pause > 0 and max_wait is not None and pause > max_wait:
+                    raise RateLimitPaused(self.paused_until)
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.in_flight >= self.limit:
+                    self.condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def pause(self, until):
+        with self.condition:
+            self.paused_until = max(self.paused_until, until)
+            self.condition.notify_all()
+
+    def update(self, remaining, reset, throttled, healthy=True):
+        with self.condition:
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+            elif remaining is not None:
+                if remaining == 0 and reset is not None:
+                    self.paused_until = max(self.paused_until, reset)
+                if remaining < LOW_REMAINING:
+                    self.limit = max(1, self.limit // 2)
+                elif healthy and self.limit < self.ceiling:
+                    self.limit += 1
+            self.condition.notify_all()
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+def get_limiter(installation, initial, ceiling):
+    with limiters_lock:
+        if not installation in limiters:
+            limiters[installation] = AdaptiveLimiter(initial, ceiling)
+        return limiters[installation]
+
+def _int_header(response, name):
+    try:
+        return int(response.headers[name])
+    except (KeyError, ValueError):
+        return None
+
+def is_rate_limited(response):
+    # primary limits are a 403/429 with no quota left, secondary limits say so in the message or send Retry-After
+    if response.status_code not in (403, 429):
+        return False
+    return _int_header(response, "X-RateLimit-Remaining") == 0 or "Retry-After" in response.headers or "rate limit" in response.text.lower()
+
+def backoff_until(response, attempt, base_delay):
+    now = time.time()
+    retry_after = _int_header(response, "Retry-After") if response is not None else None
+    if retry_after is not None:
+        return now + retry_after
+    reset = _int_header(response, "X-RateLimit-Reset") if response is not None else None
+    if reset is not None and _int_header(response, "X-RateLimit-Remaining") == 0:
+        return max(reset, now + base_delay)
+    return now + base_delay * (2 ** attempt) * (1 + random.random())
+
+def request_with_limits(limiter, url, headers, retries, base_delay=1, max_wait=None):
+    # returns the successful response, retrying rate limits, server errors and connection errors with backoff
+    # with max_wait, raises RateLimitPaused rather than sleeping through a longer rate limit pause
+    for attempt in range(retries + 1):
+        response = None
+        with limiter.slot(max_wait):
+            try:
+                response = requests.get(url, headers=headers, timeout=60)
+            except requests.RequestException as e:
+                if attempt == retries:
+                    raise
+                print(f"WARNING: {e}, retrying {url}", file=sys.stderr)
+        if response is not None:
+            throttled = is_rate_limited(response)
+            limiter.update(_int_header(response, "X-RateLimit-Remaining"), _int_header(response, "X-RateLimit-Reset"), throttled, response.status_code < 400)
+            if not throttled and response.status_code < 500:
+                response.raise_for_status()
+                return response
+            if attempt == retries:
+                if throttled:
+                    raise RateLimitError(f"rate limited after {retries + 1} attempts: {url}")
+                response.raise_for_status()
+            print(f"WARNING: {'rate limited' if throttled else response.status_code} while requesting {url}, retrying", file=sys.stderr)
+        until = backoff_until(response, attempt, base_delay)
+        if response is not None and throttled:
+            # hold every request for this installation, not just this one
+            limiter.pause(until)
+            if max_wait is not None and until - time.time() > max_wait:
+                raise RateLimitPaused(until)
+        time.sleep(max(0, until - time.time()))
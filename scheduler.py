@@ -0,0 +1,139 @@
+# Shared worker pools that run the cheapest jobs first, and admission control for memory
+
+import sys
+import time
+import threading
+import itertools
+import concurrent.futures
+from collections import namedtuple, Counter
+from contextlib import contextmanager
+
+MB = 1024 * 1024
+
+Job = namedtuple('Job', ['seq', 'group', 'cost', 'submitted', 'future', 'fn', 'args', 'kwargs', 'gate', 'not_before'])
+
+# How often idle workers recheck gated or delayed jobs, which can become ready without anything being submitted
+GATE_POLL_SECONDS = 0.5
+
+class RetryLater(Exception):
+    """Raised by a job to go back in the queue instead of finishing, to be started again after `delay` seconds."""
+
+    def __init__(self, delay=0):
+        super().__init__(f"retry in {delay:.1f}s")
+        self.delay = delay
+
+class JobScheduler:
+    """A fixed pool of worker threads shared by every pull request.
+
+    Pending jobs are picked by, in order:
+    - the group (repository) with the fewest jobs currently running, so one busy repository can't take every worker
+    - the lowest aged cost, where a job's estimated cost shrinks linearly to 0 over `aging_seconds` of waiting,
+      so large jobs are never starved by a stream of small ones
+    - submission order
+
+    Jobs submitted with a `gate` are only started while calling it returns True, so jobs that would just
+    block (say, on a paused rate limiter) are passed over and don't tie up workers.
+    """
+
+    def __init__(self, workers, aging_seconds):
+        self.workers = workers
+        self.aging_seconds = aging_seconds
+        self.condition = threading.Condition()
+        self.pending = []
+        self.running = Counter()
+        self.seq = itertools.count()
+        self.threads = []
+
+    def submit(self, group, cost, fn, *args, gate=None, **kwargs):
+        future = concurrent.futures.Future()
+        with self.condition:
+            self.pending.append(Job(next(self.seq), group, cost, time.monotonic(), future, fn, args, kwargs, gate, 0))
+            self._start_workers()
+            self.condition.notify()
+        return future
+
+    def aged_cost(self, job, now):
+        if self.aging_seconds <= 0:
+            return job.cost
+        return job.cost * max(0.0, 1.0 - (now - job.submitted) / self.aging_seconds)
+
+    def _start_workers(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"scheduler-{len(self.threads)}", daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def _next_job(self):
+        # caller must hold the condition; returns None if every pending job is gated shut
+        now = time.monotonic()
+        running = self.running
+        ready = [i for i, job in enumerate(self.pending) if job.not_before <= now and (job.gate is None or job.gate())]
+        if not ready:
+            return None
+        best = min(ready, key=lambda i: (running[self.pending[i].group], self.aged_cost(self.pending[i], now), self.pending[i].seq))
+        return self.pending.pop(best)
+
+    def _work(self):
+        while True:
+            with self.condition:
+                job = None
+                while job is None:
+                    if not self.pending:
+                        self.condition.wait()
+                        continue
+                    job = self._next_job()
+                    if job is None:
+                        self.condition.wait(GATE_POLL_SECONDS)
+                self.running[job.group] += 1
+            try:
+                if job.future.running() or job.future.set_running_or_notify_cancel():
+                    try:
+                        result = job.fn(*job.args, **job.kwargs)
+                    except RetryLater as e:
+                        # keeps its place in line, including the time it has already waited
+                        with self.condition:
+                            self.pending.append(job._replace(not_before=time.monotonic() + e.delay))
+                            self.condition.notify()
+                    except BaseException as e:
+                        job.future.set_exception(e)
+                    else:
+                        job.future.set_result(result)
+            finally:
+                with self.condition:
+                    self.running[job.group] -= 1
+                    if not self.running[job.group]:
+                        del self.running[job.group]
+
+class MemoryBudget:
+    """Admission control for memory hungry work like parsing and diffing maps.
+
+    `reserve` blocks until the estimated cost fits within the budget. A single job larger than the
+    whole budget is let through once nothing else holds a reservation, so it can't wait forever.
+    A budget of 0 disables the limit, but usage is still tracked.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.condition = threading.Condition()
+        self.in_use = 0
+        self.high_water = 0
+
+    @contextmanager
+    def reserve(self, cost, label):
+        start = time.monotonic()
+        with self.condition:
+            while self.budget > 0 and self.in_use > 0 and self.in_use + cost > self.budget:
+                self.condition.wait()
+            self.in_use += cost
+            self.high_water = max(self.high_water, self.in_use)
+            in_use = self.in_use
+            high_water = self.high_water
+        waited = time.monotonic() - start
+        if waited >= 0.01:
+            print(f"Waited {waited:.2f}s for {cost // MB} MB of memory budget for {label} ({in_use // MB} MB in use, high-water mark {high_water // MB} MB)", file=sys.stderr)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_use -= cost
+                self.condition.notify_all()
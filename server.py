@@ -5,11 +5,16 @@ import re
 import json
 import hmac
 import hashlib
-import requests
+import time
+import threading
+import urllib.parse
 import concurrent
 from datetime import datetime
-from .dmm import _parse
-from .diff import create_diff
+from .diff import create_diff_from_text, estimate_diff_memory
+from .scheduler import JobScheduler, MemoryBudget, RetryLater, MB
+from .mirror import GitMirror
+from .storage import DiffStorage, TEMP_SUFFIX
+from .ratelimit import get_limiter, request_with_limits, RateLimitPaused
 from flask import Flask, request, send_from_directory
 from github import Github, GithubIntegration
 
@@ -22,7 +27,8 @@ config_path = pathlib.Path(__file__).parent.resolve()
 config = {}
 
 try:
-    f = open(os.path.join(config_path, "config.json"))
+    # MDB_CONFIG points at another config file, e.g. for the load test harness
+    f = open(os.environ.get("MDB_CONFIG", os.path.join(config_path, "config.json")))
     config = json.load(f)
     f.close()
 except Exception as e:
@@ -77,6 +83,35 @@ if not webhook_path or len(webhook_path) == 0:
 fastdmm_host = config["fastdmm-host"]
 if fastdmm_host.endswith("/"):
     fastdmm_host[:len(fastdmm_host) - 1]
+# Settings added after the first release, which older config files don't have
+check_run_update_interval = config.get("check-run-update-interval", 10)
+scheduler_aging_seconds = config.get("scheduler-aging-seconds", 120)
+memory_budget_mb = config.get("memory-budget-mb", 1024)
+threads_network_max = config.get("threads-network-max", 20)
+download_retries = config.get("download-retries", 5)
+summary_only_threshold = config.get("summary-only-threshold", 100)
+varedit_diffs = config.get("varedit-diffs", False)
+dmm_eviction = config.get("dmm-eviction", "lru")
+if not dmm_eviction in ("lru", "oldest"):
+    print(f"DMM eviction policy must be \"lru\" or \"oldest\" in config, not {dmm_eviction!r}!", file=sys.stderr)
+    exit(1)
+storage = DiffStorage(dmm_save_path, config.get("dmm-max-size-mb", 0) * 1024 * 1024, config.get("dmm-max-files", 0),
+    dmm_eviction, config.get("dmm-gc-interval", 300))
+storage.start()
+lazy_diffs = config.get("lazy-diffs", False)
+if lazy_diffs and not config["host-dmms"]:
+    print("Lazy diffs are generated by the builtin DMM fileserver, enable host-dmms to use them!", file=sys.stderr)
+    exit(1)
+if lazy_diffs and config["use-gzip"]:
+    print("Lazy diffs are served by the builtin DMM fileserver, which does not support gzip! Disable use-gzip to use them.", file=sys.stderr)
+    exit(1)
+github_api_url = config.get("github-api-url", "https://api.github.com")
+if github_api_url.endswith("/"):
+    github_api_url = github_api_url[:len(github_api_url) - 1]
+git_mirror_path = config.get("git-mirror-path", "")
+if git_mirror_path and not os.path.exists(git_mirror_path):
+    os.makedirs(git_mirror_path)
+    print("Creating git mirror folder...")
 
 # App
 # -----------
@@ -91,12 +126,23 @@ except Exception as e:
     print("Error reading app key!", file=sys.stderr)
     exit(1)
 
+# Signs diff links that ask get_dmm to generate a diff, so only links this server made are honored
+link_key = hmac.new(app_key.encode("utf-8"), b"mdb-diff-links", hashlib.sha256).digest()
+
 app = Flask(__name__)
 git = GithubIntegration(
     config["app-id"],
     app_key,
+    base_url=github_api_url,
 )
 
+# Shared by every pull request, smallest jobs first with per-repository fairness
+# Downloads per installation are further limited by their adaptive rate limiter, up to this ceiling
+network_scheduler = JobScheduler(threads_network_max, scheduler_aging_seconds)
+fileio_scheduler = JobScheduler(config["threads-fileio"], scheduler_aging_seconds)
+# Keeps concurrent parses and diffs from growing the process past its memory limit
+memory_budget = MemoryBudget(memory_budget_mb * MB)
+
 @app.route(webhook_path, methods=["POST"])
 async def hook_receive():
     if len(config["webhook-secret"]):
@@ -128,14 +174,15 @@ async def do_request(data, owner, repo_name, full_name):
         git.get_installation(owner, repo_name).id
     ).token
     git_connection = Github(
-        login_or_token=token
+        login_or_token=token,
+        base_url=github_api_url,
     )
 
     pull_request = data["pull_request"]
     commit_head_sha = pull_request["head"]["sha"]
     before = pull_request["base"]["sha"]
     after = commit_head_sha
-    unique_id = re.sub(r'[^\w]', '-', full_name + "-" + str(pull_request["id"]) + "-" + before + "-" + after)
+    unique_id = make_unique_id(full_name, pull_request["id"], before, after)
 
     repo = git_connection.get_repo(full_name)
 
@@ -158,155 +205,388 @@ async def do_request(data, owner, repo_name, full_name):
     status="in_progress",
     started_at=get_iso_time())
 
-    diff = repo.compare(before, after)
-    maps_changed = list(filter(lambda file: file.status == "modified" and file.filename.endswith(".dmm"), diff.files))
+    try:
+        if git_mirror_path:
+            mirror = get_mirror(full_name)
+            mirror.fetch(clone_url(full_name), [before, after], token)
+            changed_files = mirror.changed_files(before, after)
+        else:
+            changed_files = repo.compare(before, after).files
+    except Exception as e:
+        print(e)
+        print(f"WARNING: Encountered error while listing changed maps for check {unique_id}", file=sys.stderr)
+        check_run_object.edit(
+        completed_at=get_iso_time(),
+        conclusion="failure",
+        output={
+            "title": "Internal error",
+            "summary": "error encountered while listing the maps changed by this pull request.",
+        }
+        )
+        return
+    maps_changed = list(filter(lambda file: file.status == "modified" and file.filename.endswith(".dmm"), changed_files))
     print(f"Created check run {unique_id} ({len(maps_changed)} maps changed)", file=sys.stderr)
 
-    result_text = "## Maps Changed\n\n" if len(maps_changed) > 0 else "No maps changed"
-
-
-    downloads = []
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=config["threads-network"]) as executor:
-        download_tasks = []
-        for file in maps_changed:
-            b = executor.submit(get_fileset, full_name, file.filename, before, after, token)
-            download_tasks.append(b)
-        print(f"Downloading {unique_id}", file=sys.stderr)
-        for future in concurrent.futures.as_completed(download_tasks):
+    # Giant PRs (or ones asking for it) only get counts; each diff is generated if someone opens its link
+    summary_only = (summary_only_threshold > 0 and len(maps_changed) > summary_only_threshold) \
+        or "[mdb summary]" in pull_request["title"].lower()
+    if summary_only:
+        print(f"Summary only for {unique_id}", file=sys.stderr)
+    # Links that let get_dmm generate the diff when it's first opened, instead of now
+    # (not with gzip, as get_dmm can't serve the .gz it would write)
+    lazy_link = None
+    if (lazy_diffs or summary_only) and config["host-dmms"] and not config["use-gzip"]:
+        lazy_link = {"repo": full_name, "pr": pull_request["id"], "base": before, "head": after}
+
+    progress = CheckRunProgress(check_run_object, unique_id, len(maps_changed))
+    # futures in flight -> (stage, filename); each map goes download -> diff (and write)
+    pending = {}
+
+    # Estimated from the compare response: the whole pull request's changed lines, so small PRs go first, plus this map's
+    pr_changes = sum(file.changes for file in maps_changed)
+    print(f"Downloading {unique_id}", file=sys.stderr)
+    # downloads for a paused or busy installation wait in the queue, not on a worker
+    gate = None if git_mirror_path else get_installation_limiter(owner).ready
+    for file in maps_changed:
+        b = network_scheduler.submit(full_name, pr_changes + file.changes, download_fileset, full_name, file.filename, before, after, token, gate=gate)
+        pending[b] = ("data download", file.filename)
+    while pending:
+        # with an interval of 0 every finished map triggers an update, so there is nothing to wake up for
+        done, _ = concurrent.futures.wait(pending, timeout=check_run_update_interval or None, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            stage, filename = pending.pop(future)
             try:
-                downloads.append(future.result())
+                result = future.result()
             except Exception as e:
                 print(e)
-                print(f"WARNING: Encountered error for check {unique_id} while performing data download", file=sys.stderr)
-                check_run_object.edit(
-                completed_at=get_iso_time(),
-                conclusion="skipped",
-                output={
-                    "title": "Internal error",
-                    "summary": "error encountered while performing data download"
-                }
-                )
-                return
-    result_entries = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=config["threads-fileio"]) as executor:
-        print(f"Parsing {unique_id}", file=sys.stderr)
-        diff_tasks = []
-        for download in downloads:
-            before_text, after_text, filename = download
-            before_dmm = _parse(before_text)
-            after_dmm = _parse(after_text)
-            d = executor.submit(create_diff, before_dmm, after_dmm, filename)
-            diff_tasks.append(d)
-        diffs = []
+                print(f"WARNING: Encountered error for check {unique_id} while performing {stage} of {filename}", file=sys.stderr)
+                progress.add_error(filename, f"error encountered while performing {stage}")
+                continue
+            if stage == "data download":
+                before_text, after_text, filename = result
+                # Once downloaded, the map's real size is the better estimate
+                map_size = len(before_text) + len(after_text)
+                if lazy_link is not None or summary_only:
+                    d = fileio_scheduler.submit(full_name, map_size, create_diff_within_budget, before_text, after_text, filename, True)
+                    pending[d] = ("diff", filename)
+                else:
+                    # written by the same job, so the diffed map stays within its memory reservation until it's saved
+                    d = fileio_scheduler.submit(full_name, map_size, create_diff_within_budget, before_text, after_text, filename,
+                        file_name_safe=diff_file_name(unique_id, filename))
+                    pending[d] = ("diff and write", filename)
+            else:
+                if summary_only:
+                    progress.add(format_summary_entry(result, unique_id, lazy_link), result[0])
+                    continue
+                if lazy_link is not None:
+                    result_entry, _ = format_result_entry(result, unique_id, full_name, before, after, len(maps_changed), lazy_link)
+                    progress.add(result_entry, result[0])
+                    continue
+                if result[1] is None:
+                    progress.add_skipped()
+                    continue
+                result_entry, _ = format_result_entry(result, unique_id, full_name, before, after, len(maps_changed))
+                progress.add(result_entry, result[0])
+        progress.update()
+    print(f"Writes complete", file=sys.stderr)
+    progress.finish()
+
+
+@app.route(dmm_url + "/<path:filename>", methods=["GET"])
+def get_dmm(filename):
+    if not config["host-dmms"]:
+        return "DMM hosting disabled, if you're seeing this, the server is probably misconfigured."
+    elif config["use-gzip"]:
+        print(f"WARNING: Server is configured to use gzip, but the builtin DMM fileserver does not support it! Disable use-gzip or use an external webserver.", file=sys.stderr)
+    if "repo" in request.args and not os.path.isfile(os.path.join(dmm_save_path, filename)):
+        # a lazy or summary only link, generate the diff now
+        error = generate_requested_diff(filename, request.args)
+        if error:
+            return error, 404
+    response = send_from_directory(directory=dmm_save_path, path=filename, as_attachment=True)
+    storage.touch(filename)
+    return response
+
+# relative path -> Future for a requested diff being generated, so concurrent requests share one
+generating = {}
+generating_lock = threading.Lock()
+
+def generate_requested_diff(relative_path, args):
+    full_name, pr_id, before, after, filename = (args.get(arg, "") for arg in DIFF_LINK_FIELDS)
+    if not all((full_name, pr_id, before, after, filename)) or full_name.count("/") != 1 or not filename.endswith(".dmm"):
+        return "invalid diff request"
+    # compared as bytes, since compare_digest rejects non-ASCII strings
+    if not hmac.compare_digest(args.get("sig", "").encode("utf-8"), sign_diff_link(full_name, pr_id, before, after, filename).encode("utf-8")):
+        return "invalid diff request"
+    file_name_safe = diff_file_name(make_unique_id(full_name, pr_id, before, after), filename)
+    if storage.relative_path(file_name_safe) != relative_path:
+        return "invalid diff request"
+    owner, repo_name = full_name.split("/")
+    if full_name in config["banned-repos"] or owner in config["banned-users"]:
+        return "invalid diff request"
+
+    with generating_lock:
+        future = generating.get(relative_path)
+        if future is not None:
+            waiting = True
+        else:
+            waiting = False
+            future = generating[relative_path] = concurrent.futures.Future()
+    if waiting:
+        return future.result()
+    try:
+        # it may have been finished by a request that was just ahead of this one
+        error = None
+        if not os.path.isfile(os.path.join(dmm_save_path, relative_path)):
+            error = generate_diff(full_name, owner, repo_name, filename, before, after, file_name_safe)
+        future.set_result(error)
+        return error
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with generating_lock:
+            del generating[relative_path]
+
+def generate_diff(full_name, owner, repo_name, filename, before, after, file_name_safe):
+    print(f"Generating requested diff {file_name_safe} ({full_name} {filename})", file=sys.stderr)
+    token = git.get_access_token(
+        git.get_installation(owner, repo_name).id
+    ).token
+    if git_mirror_path:
+        get_mirror(full_name).fetch(clone_url(full_name), [before, after], token)
+    before_text, after_text, _ = get_fileset(full_name, filename, before, after, token)
+    diff = create_diff_within_budget(before_text, after_text, filename, file_name_safe=file_name_safe)
+    if diff[1] is None:
+        return diff[2]
+    return None
+
+# Helpers
+# --------
+
+def make_unique_id(full_name, pr_id, before, after):
+    return re.sub(r'[^\w]', '-', full_name + "-" + str(pr_id) + "-" + before + "-" + after)
+
+def diff_file_name(unique_id, filename):
+    file_uuid = unique_id + "-" + re.sub(r'[^\w]', '-', filename)
+    # Generate a unique name hashed on all unique fields
+    return hashlib.sha1(file_uuid.encode("utf-8")).hexdigest() + ".dmm"
+
+def format_summary_entry(diff, unique_id, lazy_link):
+    tiles_changed, _, note, movables_added, movables_deleted, turfs_changed, areas_changed, filename = diff
+    result_entry = f"### {filename}\n\n"
+    if not note is None:
+        result_entry += f"{note}\n\n"
+    if tiles_changed > 0:
+        result_entry += f"{tiles_changed} tiles, {movables_added} movables added, {movables_deleted} movables deleted, {turfs_changed} turfs, {areas_changed} areas changed\n"
+        if lazy_link:
+            result_entry += f"Download: [diff]({diff_url(unique_id, filename, lazy_link)})\n"
+    return result_entry
+
+# Query parameters of a link that generates its diff, in signing order
+DIFF_LINK_FIELDS = ("repo", "pr", "base", "head", "path")
+
+def sign_diff_link(*fields):
+    # JSON, so no field can be split differently to get the same message
+    message = json.dumps([str(field) for field in fields]).encode("utf-8")
+    return hmac.new(link_key, message, hashlib.sha256).hexdigest()
+
+def diff_url(unique_id, filename, lazy_link=None):
+    full_url = f"{host}{dmm_url}/{storage.relative_path(diff_file_name(unique_id, filename))}"
+    if lazy_link:
+        query = dict(lazy_link, path=filename)
+        query["sig"] = sign_diff_link(*(query[field] for field in DIFF_LINK_FIELDS))
+        full_url += "?" + urllib.parse.urlencode(query)
+    return full_url
+
+def format_result_entry(diff, unique_id, full_name, before, after, maps_changed, lazy_link=None):
+    tiles_changed, diff_dmm, note, movables_added, movables_deleted, turfs_changed, areas_changed, filename = diff
+    result_entry = f"### {filename}\n\n"
+    if not note is None:
+        result_entry += f"{note}\n\n"
+    # Get around GitHub's character limit
+    if maps_changed <= 100:
+        result_entry += f"{tiles_changed} tiles changed\n"
+        result_entry += f"{movables_added} movables added, {movables_deleted} movables deleted\n"
+        result_entry += f"{turfs_changed} turfs changed\n"
+        result_entry += f"{areas_changed} areas changed\n"
+    file_name_safe = diff_file_name(unique_id, filename)
+    # lazy diffs have nothing to show for maps without visible changes
+    if lazy_link and tiles_changed == 0:
+        return result_entry, file_name_safe
+    full_url = diff_url(unique_id, filename, lazy_link)
+    result_entry += f"Download: [diff]({full_url})\n"
+    if fastdmm_host and len(fastdmm_host) > 0:
+        map_url = urllib.parse.quote(full_url, safe=":/") if lazy_link else full_url
+        result_entry += f"FastDMM: "
+        if maps_changed <= 50:
+            result_entry += f"[base repo]({fastdmm_host}?repo={full_name}&branch={before}&map={map_url}) - "
+        result_entry += f"[head repo]({fastdmm_host}?repo={full_name}&branch={after}&map={map_url})\n"
+    return result_entry, file_name_safe
+
+def write_diff(diff_dmm, file_name_safe):
+    # written to a temporary file first, so a diff being served is never half written
+    extension = ".gz" if config["use-gzip"] else ""
+    out_file_path = storage.path_for(file_name_safe)
+    temp_path = f"{out_file_path}.{os.getpid()}-{threading.get_ident()}{TEMP_SUFFIX}"
+    diff_dmm.to_file(temp_path, do_gzip=config["use-gzip"])
+    os.replace(temp_path + extension, out_file_path + extension)
+    storage.record(storage.relative_path(file_name_safe) + extension)
+
+def create_diff_within_budget(before_text, after_text, filename, stats_only=False, file_name_safe=None):
+    # with file_name_safe, the diff is also saved before its memory is released
+    with memory_budget.reserve(estimate_diff_memory(before_text, after_text), filename):
+        diff = create_diff_from_text(before_text, after_text, filename, stats_only=stats_only, varedits=varedit_diffs)
+        if file_name_safe is not None and diff[1] is not None:
+            write_diff(diff[1], file_name_safe)
+        return diff
+
+# GitHub rejects check run output text longer than this
+MAX_CHECK_RUN_TEXT = 65535
+
+class CheckRunProgress:
+    """Collects per-map results and pushes them to the check run as they come in.
+
+    Edits while in progress are rate limited by `check-run-update-interval`, and maps that
+    fail are reported alongside the others instead of discarding the whole run.
+    """
+
+    def __init__(self, check_run_object, unique_id, total):
+        self.check_run_object = check_run_object
+        self.unique_id = unique_id
+        self.total = total
+        self.entries = []
+        self.errors = []
+        self.finished = 0
+        self.last_update = None
+        self.dirty = False
+
+    def add(self, result_entry, tiles_changed):
+        self.entries.append((result_entry, tiles_changed))
+        self.finished += 1
+        self.dirty = True
+
+    def add_error(self, filename, message):
+        self.errors.append(f"### {filename}\n\n{message}\n")
+        self.finished += 1
+        self.dirty = True
+
+    def add_skipped(self):
+        self.finished += 1
+
+    def render_text(self):
+        if self.total == 0:
+            return "No maps changed"
+        result_text = "## Maps Changed\n\n"
+        # Sort by tiles changed, errors last
+        sections = [entry[0] for entry in sorted(self.entries, key=lambda entry: entry[1], reverse=True)] + self.errors
+        for i, section in enumerate(sections):
+            footer = f"\n{len(sections) - i} more map{'s' if len(sections) - i != 1 else ''} not shown\n"
+            if len(result_text) + len(section) + len(footer) > MAX_CHECK_RUN_TEXT:
+                return result_text + footer
+            result_text += section
+        return result_text
+
+    def render_title(self):
+        if self.total == 0:
+            return "No maps changed"
+        title = f"{self.total} map{'s' if self.total != 1 else ''} changed"
+        if self.errors:
+            title += f" ({len(self.errors)} failed)"
+        return title
+
+    def update(self):
+        # push partial results, at most once per interval
+        if not self.dirty:
+            return
+        if self.last_update is not None and time.monotonic() - self.last_update < check_run_update_interval:
+            return
+        self.last_update = time.monotonic()
+        self.dirty = False
         try:
-            print(f"Diffing {unique_id}", file=sys.stderr)
-            for future in concurrent.futures.as_completed(diff_tasks):
-                diffs.append(future.result())
+            self.check_run_object.edit(
+            status="in_progress",
+            output={
+                "title": f"{self.finished} of {self.total} maps processed",
+                "summary": "",
+                "text": self.render_text(),
+            }
+            )
         except Exception as e:
             print(e)
-            print(f"WARNING: Encountered error for check {unique_id} while performing diff", file=sys.stderr)
-            check_run_object.edit(
+            print(f"WARNING: Error while updating check run {self.unique_id}", file=sys.stderr)
+
+    def finish(self):
+        if self.errors and not self.entries:
+            conclusion = "skipped"
+        else:
+            conclusion = "success" if self.total > 0 else "skipped"
+        try:
+            self.check_run_object.edit(
             completed_at=get_iso_time(),
-            conclusion="skipped",
+            conclusion=conclusion,
             output={
-                "title": "Internal error",
-                "summary": "error encountered while performing diff"
+                "title": self.render_title(),
+                "summary": "",
+                "text": self.render_text(),
             }
             )
-            return
-        io_tasks = []
-        for diff in diffs:
-            tiles_changed, diff_dmm, note, movables_added, movables_deleted, turfs_changed, areas_changed, filename = diff
-            result_entry = f"### {filename}\n\n"
-            if not note is None:
-                result_entry += f"{note}\n\n"
-            if(diff_dmm == None):
-                continue
-            # Get around GitHub's character limit
-            if len(maps_changed) <= 100:
-                result_entry += f"{tiles_changed} tiles changed\n"
-                result_entry += f"{movables_added} movables added, {movables_deleted} movables deleted\n"
-                result_entry += f"{turfs_changed} turfs changed\n"
-                result_entry += f"{areas_changed} areas changed\n"
-            file_uuid = unique_id + "-" + re.sub(r'[^\w]', '-', filename)
-            # Generate a unique name hashed on all unique fields
-            file_name_safe = hashlib.sha1(file_uuid.encode("utf-8")).hexdigest() + ".dmm"
-            out_file_path = dmm_save_path + file_name_safe
-            full_url = f"{host}{dmm_url}/{file_name_safe}"
-            result_entry += f"Download: [diff]({full_url})\n"
-            if fastdmm_host and len(fastdmm_host) > 0:
-                result_entry += f"FastDMM: "
-                if len(maps_changed) <= 50:
-                    result_entry += f"[base repo]({fastdmm_host}?repo={full_name}&branch={before}&map={full_url}) - "
-                result_entry += f"[head repo]({fastdmm_host}?repo={full_name}&branch={after}&map={full_url})\n"
-            t = executor.submit(diff_dmm.to_file, out_file_path, do_gzip=config["use-gzip"])
-            io_tasks.append(t)
-            #print(f"Generated diff: {out_file_path}", file=sys.stderr)
-            result_entries.append((result_entry, tiles_changed))
-        try:
-            print(f"Starting writes", file=sys.stderr)
-            for future in concurrent.futures.as_completed(io_tasks):
-                future.result()
-            print(f"Writes complete", file=sys.stderr)
         except Exception as e:
             print(e)
-            print(f"WARNING: Encountered error for check {unique_id} while writing", file=sys.stderr)
-            check_run_object.edit(
+            print(f"WARNING: Error while editing check run {self.unique_id}", file=sys.stderr)
+            self.check_run_object.edit(
             completed_at=get_iso_time(),
             conclusion="skipped",
             output={
                 "title": "Internal error",
-                "summary": "error encountered while writing"
+                "summary": "error encountered while updating check run status. The diff may be too large.",
             }
             )
-            return
 
-    # Sort by tiles changed
-    for result_entry in sorted(result_entries, key=lambda entry: entry[1], reverse=True):
-        result_text += result_entry[0]
+# Longest rate limit pause a scheduled download sleeps through, instead of going back in the queue
+DOWNLOAD_MAX_WAIT = 5
+
+def get_installation_limiter(installation):
+    # installations share quota, so each gets its own limiter starting at threads-network
+    return get_limiter(installation, config["threads-network"], threads_network_max)
+
+def get_file(url, token, installation, max_wait=None):
+    limiter = get_installation_limiter(installation)
+    return request_with_limits(limiter, url, {"Accept": "application/vnd.github.3.raw", "Authorization": f"Bearer {token}"}, download_retries, max_wait=max_wait).text
+
+mirrors = {}
+mirrors_lock = threading.Lock()
+
+def clone_url(full_name):
+    # the web host that goes with github-api-url: api.github.com for GitHub, <host>/api/v3 for GitHub Enterprise
+    api = urllib.parse.urlsplit(github_api_url)
+    netloc, path = api.netloc, api.path
+    if netloc.startswith("api."):
+        netloc = netloc[len("api."):]
+    elif path.endswith("/api/v3"):
+        path = path[:-len("/api/v3")]
+    return f"{api.scheme}://{netloc}{path}/{full_name}.git"
+
+def get_mirror(full_name):
+    with mirrors_lock:
+        if not full_name in mirrors:
+            mirrors[full_name] = GitMirror(os.path.join(git_mirror_path, full_name + ".git"), config.get("git-mirror-max-pins", 1000))
+        return mirrors[full_name]
+
+def get_fileset(full_name, filename, before, after, token, max_wait=None):
+    if git_mirror_path:
+        return get_mirror(full_name).get_fileset(filename, before, after)
+    owner = full_name.split("/")[0]
+    before = get_file(f"{github_api_url}/repos/{full_name}/contents/{filename}?ref={before}", token, owner, max_wait)
+    after = get_file(f"{github_api_url}/repos/{full_name}/contents/{filename}?ref={after}", token, owner, max_wait)
+    return (before, after, filename)
 
+def download_fileset(full_name, filename, before, after, token):
+    # runs on the network scheduler, where a long rate limit pause puts the download back in the queue
     try:
-        check_run_object.edit(
-        completed_at=get_iso_time(),
-        conclusion="success" if len(maps_changed) > 0 else "skipped",
-        output={
-            "title": f"{len(maps_changed)} map{'s' if len(maps_changed) != 1 else ''} changed" if len(maps_changed) > 0 else "No maps changed",
-            "summary": "",
-            "text": result_text,
-        }
-        )
-    except Exception as e:
-        print(e)
-        print(f"WARNING: Error while editing check run {unique_id}", file=sys.stderr)
-        check_run_object.edit(
-        completed_at=get_iso_time(),
-        conclusion="skipped",
-        output={
-            "title": "Internal error",
-            "summary": "error encountered while updating check run status. The diff may be too large.",
-        }
-        )
-
-
-@app.route(dmm_url + "/<filename>", methods=["GET"])
-def get_dmm(filename):
-    if not config["host-dmms"]:
-        return "DMM hosting disabled, if you're seeing this, the server is probably misconfigured."
-    elif config["use-gzip"]:
-        print(f"WARNING: Server is configured to use gzip, but the builtin DMM fileserver does not support it! Disable use-gzip or use an external webserver.", file=sys.stderr)
-    return send_from_directory(directory=dmm_save_path, path=filename, as_attachment=True)
-
-# Helpers
-# --------
-
-def get_file(url, token):
-    return requests.get(url, headers={"Accept": "application/vnd.github.3.raw", "Authorization": f"Bearer {token}"}).text
-
-def get_fileset(full_name, filename, before, after, token):
-    before =  get_file(f"https://api.github.com/repos/{full_name}/contents/{filename}?ref={before}", token)
-    after = get_file(f"https://api.github.com/repos/{full_name}/contents/{filename}?ref={after}", token)
-    return (before, after, filename)
+        return get_fileset(full_name, filename, before, after, token, DOWNLOAD_MAX_WAIT)
+    except RateLimitPaused as e:
+        raise RetryLater(e.until - time.time())
 
 def get_iso_time():
     return datetime.utcnow().replace(microsecond=0)
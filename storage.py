@@ -0,0 +1,166 @@
+# Sharded storage for generated diffs, with size-bounded retention
+
+import os
+import sys
+import time
+import hashlib
+import threading
+
+# Deletions made before the collector yields to other threads
+GC_BATCH = 100
+# Diffs still being written have this in their name, and are left alone
+TEMP_SUFFIX = ".tmp"
+
+class DiffStorage:
+    """Stores diffs under root/<shard>/<name>, where the shard is the first two hex digits of the name's SHA-1.
+
+    Access times are set explicitly when a diff is written or served, since filesystems are often mounted
+    noatime. A background thread periodically rescans the folder one shard at a time and deletes the least
+    recently used (or, with the "oldest" policy, the oldest written) diffs until the total is back under
+    `max_bytes` and `max_files`. A budget of 0 is unlimited. Flat files from before sharding are still
+    found and are collected like any other diff.
+    """
+
+    def __init__(self, root, max_bytes, max_files, policy, interval):
+        if not policy in ("lru", "oldest"):
+            raise ValueError(f"unknown eviction policy: {policy}")
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.policy = policy
+        self.interval = interval
+        # without a budget nothing is ever collected, so nothing needs tracking
+        self.enabled = max_bytes > 0 or max_files > 0
+        self.lock = threading.Lock()
+        # path relative to root -> (size, access time, modification time)
+        self.index = {}
+        self.total_bytes = 0
+        # entries recorded while a rescan is in progress, merged in when it finishes
+        self.recent = None
+        self.thread = None
+
+    @staticmethod
+    def shard_for(name):
+        return hashlib.sha1(name.encode("utf-8")).hexdigest()[:2]
+
+    def relative_path(self, name):
+        return f"{self.shard_for(name)}/{name}"
+
+    def path_for(self, name):
+        # creates the shard directory so the returned path can be written to directly
+        directory = os.path.join(self.root, self.shard_for(name))
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, name)
+
+    def _update(self, relative, entry):
+        # caller must hold the lock
+        old = self.index.get(relative)
+        if old is not None:
+            self.total_bytes -= old[0]
+        self.index[relative] = entry
+        self.total_bytes += entry[0]
+        if self.recent is not None:
+            self.recent[relative] = entry
+
+    def record(self, relative):
+        if not self.enabled:
+            return
+        stat = os.stat(os.path.join(self.root, relative))
+        with self.lock:
+            self._update(relative, (stat.st_size, stat.st_atime, stat.st_mtime))
+
+    def touch(self, relative):
+        if not self.enabled:
+            return
+        path = os.path.join(self.root, relative)
+        try:
+            stat = os.stat(path)
+            now = time.time()
+            os.utime(path, (now, stat.st_mtime))
+        except OSError:
+            return
+        with self.lock:
+            self._update(relative, (stat.st_size, now, stat.st_mtime))
+
+    def over_budget(self):
+        # caller must hold the lock
+        return (self.max_bytes > 0 and self.total_bytes > self.max_bytes) or (self.max_files > 0 and len(self.index) > self.max_files)
+
+    def start(self):
+        if not self.enabled or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._gc_loop, name="diff-storage-gc", daemon=True)
+        self.thread.start()
+
+    def _gc_loop(self):
+        while True:
+            try:
+                self.rescan()
+                self.collect()
+            except Exception as e:
+                print(e)
+                print(f"WARNING: Encountered error while collecting diffs in {self.root}", file=sys.stderr)
+            time.sleep(self.interval)
+
+    def _scan_directory(self, directory, prefix, index):
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and not TEMP_SUFFIX in entry.name:
+                    stat = entry.stat(follow_symlinks=False)
+                    index[prefix + entry.name] = (stat.st_size, stat.st_atime, stat.st_mtime)
+
+    def rescan(self):
+        # rebuilds the index from disk one shard at a time, yielding in between
+        with self.lock:
+            self.recent = {}
+        index = {}
+        try:
+            self._scan_directory(self.root, "", index)
+            for entry in sorted(os.listdir(self.root)):
+                if len(entry) == 2 and os.path.isdir(os.path.join(self.root, entry)):
+                    self._scan_directory(os.path.join(self.root, entry), entry + "/", index)
+                    time.sleep(0)
+        except:
+            with self.lock:
+                self.recent = None
+            raise
+        with self.lock:
+            recent, self.recent = self.recent, None
+            index.update(recent)
+            self.index = index
+            self.total_bytes = sum(entry[0] for entry in index.values())
+
+    def collect(self):
+        with self.lock:
+            if not self.over_budget():
+                return 0
+            time_field = 1 if self.policy == "lru" else 2
+            candidates = sorted(self.index.items(), key=lambda item: item[1][time_field])
+        deleted = 0
+        freed = 0
+        for relative, entry in candidates:
+            with self.lock:
+                if not self.over_budget():
+                    break
+                # skip anything used or rewritten since the candidates were sorted
+                if self.index.get(relative) != entry:
+                    continue
+            try:
+                os.remove(os.path.join(self.root, relative))
+            except FileNotFoundError:
+                pass
+            with self.lock:
+                if self.index.get(relative) == entry:
+                    del self.index[relative]
+                    self.total_bytes -= entry[0]
+            deleted += 1
+            freed += entry[0]
+            if deleted % GC_BATCH == 0:
+                time.sleep(0.01)
+        if deleted:
+            print(f"Collected {deleted} diffs ({freed // (1024 * 1024)} MB) from {self.root}", file=sys.stderr)
+        return deleted
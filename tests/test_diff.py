@@ -0,0 +1,27 @@
+import unittest
+from ..diff import create_diff
+from ..dmm import DMM, Coordinate, parse_map_atom
+
+def single_tile_map(atom):
+    dmm = DMM(1, Coordinate(1, 1, 1))
+    dmm.set_tile((1, 1, 1), (atom, "/turf/open/floor", "/area/station"))
+    return dmm
+
+class VareditMarkerTest(unittest.TestCase):
+    def test_quoted_values_stay_on_one_line(self):
+        old = single_tile_map('/obj/structure/sign{info = "x; y}"; dir = 4}')
+        new = single_tile_map('/obj/structure/sign{info = "x; z"; dir = 8}')
+        tiles_changed, diff_dmm, _, movables_added, movables_deleted, _, _, _ = create_diff(old, new, "test.dmm", varedits=True)
+        self.assertEqual((tiles_changed, movables_added, movables_deleted), (1, 0, 0))
+
+        text = diff_dmm.to_bytes().decode("utf-8")
+        desc_lines = [line for line in text.splitlines() if line.lstrip().startswith("desc = ")]
+        self.assertEqual(len(desc_lines), 1)
+        self.assertEqual(desc_lines[0].strip(), "desc = \"info: 'x; y}' TO 'x; z'; dir: 4 TO 8\"")
+
+        # the diff still parses back to the same atoms
+        reparsed = DMM.from_bytes(text.encode("utf-8")).get_tile((1, 1, 1))
+        self.assertEqual([parse_map_atom(atom) for atom in reparsed], [parse_map_atom(atom) for atom in diff_dmm.get_tile((1, 1, 1))])
+
+if __name__ == "__main__":
+    unittest.main()